@@ -0,0 +1,3 @@
+"""
+Benchmarks for the inbox hot paths, run with `python runbenchmarks.py`, see `--help`.
+"""
@@ -0,0 +1,144 @@
+"""
+Each case sets up its own state then runs the operation being measured, returning how many operations it ran. Cases
+run in a transaction that's rolled back afterwards so they all start from the same seeded database.
+"""
+from datetime import timedelta
+
+from django.test import Client
+from django.utils import timezone
+
+from inbox.models import Message, perform_user_maintenance, reconcile_default_preferences, reconcile_preferences
+from inbox.utils import drain_new_messages, drain_new_message_logs
+
+from benchmarks import seed
+
+DRAIN_DEADLINE = timedelta(hours=1)
+
+
+class Case:
+
+    name = None
+    # INBOX_CONFIG overrides for the case
+    config = {}
+
+    def __init__(self, messages_per_user: int):
+        self.messages_per_user = messages_per_user
+
+    def setup(self, users):
+        pass
+
+    def run(self, users) -> int:
+        raise NotImplementedError
+
+
+class MessageCreate(Case):
+
+    name = 'message_create'
+
+    def run(self, users):
+        return seed.create_messages(users, self.messages_per_user)
+
+
+class ProcessNewMessages(Case):
+
+    name = 'process_new_messages'
+
+    def setup(self, users):
+        seed.create_messages(users, self.messages_per_user)
+
+    def run(self, users):
+        return drain_new_messages(deadline=DRAIN_DEADLINE)
+
+
+class ProcessNewMessageLogs(Case):
+
+    name = 'process_new_message_logs'
+
+    def setup(self, users):
+        seed.create_messages(users, self.messages_per_user)
+        drain_new_messages(deadline=DRAIN_DEADLINE)
+
+    def run(self, users):
+        return drain_new_message_logs(deadline=DRAIN_DEADLINE)
+
+
+class EndpointCase(Case):
+
+    def get_url(self, user) -> str:
+        raise NotImplementedError
+
+    def setup(self, users):
+        self.clients = []
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            self.clients.append((client, user))
+
+    def run(self, users):
+        for client, user in self.clients:
+            response = client.get(self.get_url(user))
+            if response.status_code != 200:
+                raise AssertionError(f'{self.name} responded {response.status_code} for User {user.pk}')
+
+        return len(self.clients)
+
+
+class MessagesList(EndpointCase):
+
+    name = 'messages_list'
+
+    def get_url(self, user):
+        return f'/api/v1/users/{user.pk}/messages'
+
+
+class UnreadCount(EndpointCase):
+
+    name = 'unread_count'
+
+    def get_url(self, user):
+        return f'/api/v1/users/{user.pk}/messages/unread_count'
+
+
+class MessagePreferencesList(EndpointCase):
+
+    name = 'message_preferences'
+
+    def get_url(self, user):
+        return f'/api/v1/users/{user.pk}/message_preferences'
+
+
+class UserMaintenance(Case):
+
+    name = 'user_maintenance'
+    config = {
+        'PER_USER_MESSAGES_MAX_AGE': timedelta(days=1),
+        'PER_USER_MESSAGES_MIN_COUNT': 1,
+    }
+
+    def setup(self, users):
+        # Age the seeded history so there's something to delete
+        Message.objects.filter(user__in=users).update(send_at=timezone.now() - timedelta(days=2))
+
+    def run(self, users):
+        for user in users:
+            perform_user_maintenance(user)
+
+        return len(users)
+
+
+class ReconcilePreferences(Case):
+
+    name = 'reconcile_preferences'
+
+    def run(self, users):
+        for user in users:
+            stored_preferences = user.message_preferences._groups
+            preferences = reconcile_default_preferences(stored_preferences)
+            reconcile_preferences(stored_preferences, [{'id': preference['id'], 'email': False}
+                                                       for preference in preferences])
+
+        return len(users)
+
+
+CASES = [MessageCreate, ProcessNewMessages, ProcessNewMessageLogs, MessagesList, UnreadCount, MessagePreferencesList,
+         UserMaintenance, ReconcilePreferences]
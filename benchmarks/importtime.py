@@ -0,0 +1,67 @@
+"""
+Start up cost of a fresh process that sets up Django and imports what processing messages needs, as a cron job or
+`inbox_worker` does. Each run is a new interpreter under `python -X importtime`.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+SCRIPT = '''
+import time
+started_at = time.perf_counter()
+import django
+django.setup()
+import inbox.utils
+import inbox.management.commands.inbox_worker
+print(time.perf_counter() - started_at)
+'''
+
+
+def parse_importtime(stderr: str):
+    """
+    :return: module to (self, cumulative) microseconds
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules[module.strip()] = (int(self_us), int(cumulative_us))
+
+    return modules
+
+
+def run_once():
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT], capture_output=True, text=True,
+                             env=os.environ.copy(), check=True)
+    modules = parse_importtime(process.stderr)
+
+    return float(process.stdout.strip().splitlines()[-1]), modules
+
+
+def run(repeat: int = 5):
+    runs = [run_once() for i in range(repeat)]
+
+    wall_times = [wall_time for wall_time, modules in runs]
+    import_times = [sum(self_us for self_us, cumulative_us in modules.values()) / 1e6 for wall_time, modules in runs]
+    inbox_import_times = [
+        sum(self_us for module, (self_us, cumulative_us) in modules.items() if module.split('.')[0] == 'inbox') / 1e6
+        for wall_time, modules in runs
+    ]
+
+    # Slowest imports of the median run by cumulative time, what to look at first
+    wall_time, modules = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:10]
+
+    return {
+        'name': 'import_time',
+        'count': 1,
+        'wall_time': statistics.median(wall_times),
+        'wall_time_min': min(wall_times),
+        'import_time': statistics.median(import_times),
+        'inbox_import_time': statistics.median(inbox_import_times),
+        'slowest_imports': [{'module': module, 'cumulative_time': cumulative_us / 1e6}
+                            for module, (self_us, cumulative_us) in slowest],
+    }
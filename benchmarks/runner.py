@@ -0,0 +1,193 @@
+import gc
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test.utils import setup_test_environment, teardown_test_environment, setup_databases, \
+    teardown_databases, override_settings
+
+from inbox import settings as inbox_settings
+from inbox.core import app_push
+
+from benchmarks import importtime, seed
+from benchmarks.cases import CASES
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def case_config(case):
+    if not case.config:
+        yield
+        return
+
+    INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+    INBOX_CONFIG.update(case.config)
+    with override_settings(INBOX_CONFIG=INBOX_CONFIG):
+        inbox_settings.get_config.cache_clear()
+        try:
+            yield
+        finally:
+            inbox_settings.get_config.cache_clear()
+
+
+def run_once(case, users, trace_memory=False):
+    """
+    Set up and run the case in a transaction that's rolled back, so every run starts from the seeded database.
+
+    :return: (count, wall_time, queries, peak_memory)
+    """
+    for cache in caches.all():
+        cache.clear()
+    app_push.outbox = []
+
+    with case_config(case), transaction.atomic():
+        case.setup(users)
+
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+
+        counter = QueryCounter()
+        try:
+            with connection.execute_wrapper(counter):
+                started_at = time.perf_counter()
+                count = case.run(users)
+                wall_time = time.perf_counter() - started_at
+
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+
+        transaction.set_rollback(True)
+
+    return count, wall_time, counter.count, peak_memory
+
+
+def run_case(case, users, repeat: int):
+    """
+    Time the case over `repeat` runs, then run it once more under tracemalloc for its peak memory, which slows the run
+    down too much to time it at the same time.
+    """
+    wall_times = []
+    for i in range(repeat):
+        count, wall_time, queries, _ = run_once(case, users)
+        wall_times.append(wall_time)
+
+    _, _, _, peak_memory = run_once(case, users, trace_memory=True)
+
+    wall_time = statistics.median(wall_times)
+    return {
+        'name': case.name,
+        'count': count,
+        'wall_time': wall_time,
+        'wall_time_min': min(wall_times),
+        'wall_time_per_op': wall_time / count if count else None,
+        'queries': queries,
+        'queries_per_op': queries / count if count else None,
+        'peak_memory': peak_memory,
+    }
+
+
+def compare(results, baseline):
+    """
+    :return: lines describing how each result changed from the matching baseline result
+    """
+    baseline = {result['name']: result for result in baseline['results']}
+
+    lines = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+
+        changes = []
+        for key in ('wall_time', 'queries', 'peak_memory', 'import_time'):
+            if previous.get(key) and result.get(key) is not None:
+                changes.append(f'{key} {(result[key] - previous[key]) / previous[key]:+.1%}')
+
+        lines.append(f'{result["name"]}: {", ".join(changes)}')
+
+    return lines
+
+
+def format_result(result):
+    return (f'{result["name"]:<28} {result["count"]:>6} ops {result["wall_time"] * 1000:>10.1f}ms '
+            f'{result["queries"]:>7} queries {result["peak_memory"] / 1024:>10.1f}KiB')
+
+
+def run(users: int, messages_per_user: int, repeat: int = 3, only=None, output=None, baseline=None, verbosity=1):
+    cases = [case_class(messages_per_user) for case_class in CASES if not only or case_class.name in only]
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=max(verbosity - 1, 0), interactive=False)
+
+    try:
+        seeded_users = seed.seed(users, messages_per_user)
+
+        results = []
+        for case in cases:
+            result = run_case(case, seeded_users, repeat)
+            results.append(result)
+            if verbosity:
+                print(format_result(result))
+    finally:
+        teardown_databases(old_config, verbosity=max(verbosity - 1, 0))
+        teardown_test_environment()
+
+    return write_report({
+        'users': users,
+        'messages_per_user': messages_per_user,
+        'repeat': repeat,
+    }, results, output, baseline, verbosity)
+
+
+def run_import_time(repeat: int = 5, output=None, baseline=None, verbosity=1):
+    result = importtime.run(repeat)
+
+    if verbosity:
+        print(f'{result["name"]:<28} {result["wall_time"] * 1000:>10.1f}ms to set up and import, '
+              f'{result["import_time"] * 1000:.1f}ms importing of which inbox {result["inbox_import_time"] * 1000:.1f}ms')
+        for slowest_import in result['slowest_imports']:
+            print(f'    {slowest_import["module"]:<40} {slowest_import["cumulative_time"] * 1000:>8.1f}ms')
+
+    return write_report({'repeat': repeat}, [result], output, baseline, verbosity)
+
+
+def write_report(meta, results, output=None, baseline=None, verbosity=1):
+    report = {
+        'meta': {
+            **meta,
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    if baseline and verbosity:
+        for line in compare(results, baseline):
+            print(line)
+
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+    return report
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from inbox.models import Message
+from inbox.utils import drain_new_messages, drain_new_message_logs
+
+User = get_user_model()
+
+# Message keys from the test settings whose hooks don't skip logging, between them they log app pushes and emails
+MESSAGE_KEYS = ('account_updated', 'default')
+
+
+def create_users(count: int, prefix: str = 'benchmark'):
+    users = User.objects.bulk_create([
+        User(email=f'{prefix}+{i}@example.com', username=f'{prefix}+{i}@example.com',
+             email_verified_on=timezone.now().date())
+        for i in range(count)
+    ])
+
+    for user in users:
+        user.device_group.notification_key = f'{prefix}-notification-key-{user.pk}'
+        user.device_group.save()
+
+    return list(User.objects.filter(pk__in=[user.pk for user in users]).order_by('pk'))
+
+
+def create_messages(users, messages_per_user: int):
+    """
+    Create new, unprocessed messages spread evenly over the users and message keys.
+
+    :return: number of messages created
+    """
+    count = 0
+    for i in range(messages_per_user):
+        for user in users:
+            Message.objects.create(user=user, key=MESSAGE_KEYS[i % len(MESSAGE_KEYS)])
+            count += 1
+
+    return count
+
+
+def drain():
+    deadline = timedelta(hours=1)
+
+    return drain_new_messages(deadline=deadline), drain_new_message_logs(deadline=deadline)
+
+
+def seed(users: int, messages_per_user: int):
+    """
+    Users with a processed and sent message history, the state the benchmark cases run against.
+    """
+    users = create_users(users)
+    create_messages(users, messages_per_user)
+    drain()
+
+    return users
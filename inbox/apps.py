@@ -4,3 +4,20 @@ from django.apps import AppConfig
 class InboxConfig(AppConfig):
     default_auto_field = 'django.db.models.AutoField'
     name = 'inbox'
+
+    def ready(self):
+        from django.core.signals import setting_changed
+        from django.db.backends.signals import connection_created
+
+        from inbox import metrics, settings as inbox_settings
+
+        # Compile the config up front rather than on the first message
+        config = inbox_settings.get_config()
+        setting_changed.connect(inbox_settings.setting_changed_receiver)
+        connection_created.connect(metrics.install_query_counter)
+
+        # The stream pulls in DRF and threading, only pay for it when it's used
+        if config['STREAM_BACKEND']:
+            from inbox import stream
+
+            stream.connect_signals()
@@ -0,0 +1,69 @@
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+from inbox import settings as inbox_settings
+
+
+def get_cache():
+    alias = inbox_settings.get_config()['MESSAGES_LIST_CACHE']
+    if not alias:
+        return None
+
+    return caches[alias]
+
+
+def _version_key(user_id):
+    return f'inbox:version:{user_id}'
+
+
+def get_inbox_version(user_id):
+    """
+    The version is bumped every time anything that changes a User's inbox happens, cached responses are keyed by it so
+    they never have to be explicitly invalidated.
+    """
+    cache = get_cache()
+    key = _version_key(user_id)
+
+    version = cache.get(key)
+    if version is None:
+        # Start from something that hasn't been used before in case the version was evicted
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_inbox_version(user_id):
+    cache = get_cache()
+    if cache is None:
+        return
+
+    def bump():
+        try:
+            cache.incr(_version_key(user_id))
+        except ValueError:
+            cache.add(_version_key(user_id), time.time_ns(), None)
+
+    # Bumping before commit would let a concurrent request cache the old data under the new version
+    transaction.on_commit(bump)
+
+
+def make_etag(*parts):
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    return f'W/"{digest}"'
+
+
+def get_etag(user_id, path):
+    return make_etag(user_id, get_inbox_version(user_id), path)
+
+
+def get_cached_response_data(etag):
+    return get_cache().get(f'inbox:response:{etag}')
+
+
+def set_cached_response_data(etag, data):
+    get_cache().set(f'inbox:response:{etag}', data, inbox_settings.get_config()['MESSAGES_LIST_CACHE_TIMEOUT'])
@@ -1,3 +1,4 @@
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -8,6 +9,10 @@ class BaseAppPushBackend:
     Base class for app push backend implementations.
 
     Subclasses must at least overwrite send_messages().
+
+    AppPushMessage.idempotency_key is the same each time a MessageLog is sent, backends that can should use it so a
+    resumed send isn't delivered twice. A failed send is recorded on AppPushMessage.message_log (status and
+    failure_reason) without saving it, the caller saves the log.
     """
     def __init__(self, fail_silently=False, **kwargs):
         self.fail_silently = fail_silently
@@ -19,4 +24,11 @@ class BaseAppPushBackend:
         """
         raise NotImplementedError('subclasses of BaseAppPushBackend must override send_messages() method')
 
+    async def async_send_messages(self, messages):
+        """
+        Async counterpart of send_messages(). By default it runs send_messages() in a worker thread, so it mustn't
+        use the database, backends with a native async client should override it.
+        """
+        return await sync_to_async(self.send_messages, thread_sensitive=False)(messages)
+
 
@@ -6,7 +6,6 @@ from inbox import settings as inbox_settings
 from inbox.constants import MessageLogStatus
 from inbox.core.app_push.backends.base import BaseAppPushBackend
 from inbox.core.app_push.message import AppPushMessage
-from pyfcm import FCMNotification
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +16,9 @@ class AppPushBackend(BaseAppPushBackend):
     dry_run = False
 
     def __init__(self, fail_silently=False, dry_run=False):
+        # Imported with the first backend rather than with inbox, pyfcm brings in the Google auth libraries
+        from pyfcm import FCMNotification
+
         super().__init__(fail_silently=fail_silently)
 
         self.dry_run = dry_run
@@ -55,18 +57,28 @@ class AppPushBackend(BaseAppPushBackend):
                     if content_available
                     else None
                 )
+                android_config = None
+                if message.idempotency_key:
+                    # FCM has no idempotency, but a resent notification with the same collapse id / tag replaces
+                    # the one already shown rather than showing twice
+                    apns_config = apns_config or {}
+                    apns_config["headers"] = {"apns-collapse-id": message.idempotency_key}
+                    if not content_available:
+                        android_config = {"notification": {"tag": message.idempotency_key}}
                 response = self.fcm.notify(
                     fcm_token=message.entity.notification_key,
                     notification_title=message.title,
                     notification_body=message.body,
                     data_payload=data,
+                    android_config=android_config,
                     apns_config=apns_config,
                 )
             except Exception as msg:
                 if message.message_log:
+                    # Saved by the caller with the rest of the send's outcome, this may be running in a thread that
+                    # shouldn't touch the database
                     message.message_log.status = MessageLogStatus.FAILED
                     message.message_log.failure_reason = str(msg)
-                    message.message_log.save()
                 logger.warning(msg)
                 logger.warning(
                     "Exception when calling notify for {}".format(
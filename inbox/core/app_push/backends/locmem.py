@@ -24,6 +24,13 @@ class AppPushBackend(BaseAppPushBackend):
             if not message.entity.notification_key:
                 continue
 
+            if message.idempotency_key and \
+                    any(m.idempotency_key == message.idempotency_key for m in app_push.outbox):
+                continue
+
             app_push.outbox.append(message)
             msg_count += 1
         return msg_count
+
+    async def async_send_messages(self, messages):
+        return self.send_messages(messages)
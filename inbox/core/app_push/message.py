@@ -3,13 +3,15 @@ class AppPushMessage:
 
     message_log = None
 
-    def __init__(self, entity, title=None, body=None, data=None, message_log=None, connection=None):
+    def __init__(self, entity, title=None, body=None, data=None, message_log=None, connection=None,
+                 idempotency_key=None):
         self.entity = entity
         self.title = title
         self.body = body
         self.data = data or {}
         self.message_log = message_log
         self.connection = connection
+        self.idempotency_key = idempotency_key or (message_log.idempotency_key if message_log else None)
 
     def get_connection(self, fail_silently=False):
         from inbox.core.app_push import get_connection
@@ -19,3 +21,6 @@ class AppPushMessage:
 
     def send(self, fail_silently=False):
         return self.get_connection(fail_silently).send_messages([self])
+
+    async def async_send(self, fail_silently=False):
+        return await self.get_connection(fail_silently).async_send_messages([self])
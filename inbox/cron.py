@@ -1,17 +1,32 @@
 from django.http import HttpResponse
 
-from inbox.utils import process_new_messages, process_new_message_logs
+from inbox.utils import drain_new_messages, drain_new_message_logs, parse_shard
+
+
+def _get_shard(request):
+    try:
+        return parse_shard(request.GET.get('shard')), None
+    except ValueError as e:
+        return None, HttpResponse(str(e), status=400)
 
 
 def view_process_new_messages(request):
 
-    process_new_messages()
+    shard, error_response = _get_shard(request)
+    if error_response:
+        return error_response
+
+    drain_new_messages(shard=shard)
 
     return HttpResponse(status=200)
 
 
 def view_process_new_message_logs(request):
 
-    process_new_message_logs()
+    shard, error_response = _get_shard(request)
+    if error_response:
+        return error_response
+
+    drain_new_message_logs(shard=shard)
 
     return HttpResponse(status=200)
@@ -0,0 +1,28 @@
+"""
+Per message key hooks, looked up as `<HOOKS_MODULE>.<message key>.<hook name>` when first needed rather than when
+inbox is imported, so HOOKS_MODULE follows the current config.
+"""
+from functools import lru_cache
+
+from django.utils.module_loading import import_string
+
+from inbox import settings as inbox_settings
+
+
+@lru_cache(maxsize=None)
+def _import_hook(hooks_module: str, key: str, name: str):
+    try:
+        return import_string(f'{hooks_module}.{key}.{name}')
+    except ImportError:
+        return None
+
+
+def get_hook(key: str, name: str):
+    """
+    :return: the hook function, or None if HOOKS_MODULE isn't set or the message key doesn't define it
+    """
+    hooks_module = inbox_settings.get_config()['HOOKS_MODULE']
+    if not hooks_module:
+        return None
+
+    return _import_hook(hooks_module, key, name)
@@ -1,21 +1,70 @@
+import json
+
 from django.core.management.base import BaseCommand, CommandError
-from django.template import loader, TemplateDoesNotExist
 
-from beautifultable import BeautifulTable
 from inbox import settings as inbox_settings
 from inbox.constants import MessageMedium
 from inbox.models import MessageLog
+from inbox.status import get_queue_status, get_template_index, template_exists, compile_templates
 
 
 class Command(BaseCommand):
-    help = 'Use inbox config and determine if necessary templates are available.'
-
-    # def add_arguments(self, parser):
-    #     parser.add_argument('poll_ids', nargs='+', type=int)
+    help = 'Report queue health and use inbox config to determine if necessary templates are available.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', dest='as_json',
+                            help='Write the report as JSON, eg for alerting.')
+        parser.add_argument('--skip-queue', action='store_true',
+                            help="Don't report queue counts, lag and throughput.")
+        parser.add_argument('--skip-templates', action='store_true',
+                            help="Don't check templates.")
+        parser.add_argument('--compile', action='store_true',
+                            help='Also compile the templates that were found to check their syntax.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes to compile templates in with --compile, defaults to one per CPU.')
 
     def handle(self, *args, **options):
+        queue_status = None if options['skip_queue'] else get_queue_status()
+        message_groups = None if options['skip_templates'] else \
+            self.get_templates(options['compile'], options['workers'])
+
+        if options['as_json']:
+            self.stdout.write(json.dumps({'queue': queue_status, 'templates': message_groups}, indent=2))
+            return
+
+        if queue_status is not None:
+            self.write_queue_status(queue_status)
+
+        if message_groups is not None:
+            self.write_templates(message_groups)
+
+    def write_queue_status(self, queue_status):
+        # Optional dependency, only needed for the tables
+        from beautifultable import BeautifulTable
+
+        messages = queue_status['messages']
+        message_logs = queue_status['message_logs']
+
+        self.stdout.write(f'Unlogged messages: {messages["unlogged"]}, lag {messages["lag_seconds"]:.0f}s')
+        self.stdout.write(f'New message logs lag {message_logs["lag_seconds"]:.0f}s, '
+                          f'{message_logs["expired_claims"]} queued with an expired claim')
+        self.stdout.write('Message logs by medium, sent/failed over the last window:')
+
+        table = BeautifulTable()
+        table.column_headers = ['Medium', 'New', 'Queued'] + [
+            f'Last {window["window_seconds"]:.0f}s' for window in queue_status['throughput']
+        ]
+        for medium in MessageMedium.keys():
+            table.append_row([medium, message_logs['new'][medium], message_logs['queued'][medium]] + [
+                f'{window["sent"][medium]}/{window["failed"][medium]}' for window in queue_status['throughput']
+            ])
+
+        self.stdout.write(str(table))
+
+    def get_templates(self, compile=False, workers=None):
+        index = get_template_index()
 
-        used_template_names = []
+        used_template_names = set()
         message_groups = []
         for message_group in inbox_settings.get_config()['MESSAGE_GROUPS']:
             for k, v in message_group['preference_defaults'].items():
@@ -32,26 +81,26 @@ class Command(BaseCommand):
                         if template_name in used_template_names:
                             continue
 
-                        used_template_names.append(template_name)
-
-                        try:
-                            loader.get_template(template_name)
-                        except TemplateDoesNotExist:
-                            message_groups.append({
-                                               'file': template_name,
-                                               'key': message_key,
-                                               'medium': k.lower(),
-                                               'required': required,
-                                               'found': False
-                                                  })
-                        else:
-                            message_groups.append({
-                                               'file': template_name,
-                                               'key': message_key,
-                                               'medium': k.lower(),
-                                               'required': required,
-                                               'found': True
-                                                  })
+                        used_template_names.add(template_name)
+
+                        message_groups.append({
+                                           'file': template_name,
+                                           'key': message_key,
+                                           'medium': k.lower(),
+                                           'required': required,
+                                           'found': template_exists(template_name, index)
+                                              })
+
+        if compile:
+            errors = compile_templates([mg['file'] for mg in message_groups if mg['found']], workers)
+            for mg in message_groups:
+                if mg['found']:
+                    mg['error'] = errors.get(mg['file'])
+
+        return message_groups
+
+    def write_templates(self, message_groups):
+        from beautifultable import BeautifulTable
 
         table = BeautifulTable()
         table.column_headers = ['File', 'Required', 'Found']
@@ -112,3 +161,7 @@ class Command(BaseCommand):
             final_table.append_row(row)
 
         self.stdout.write(str(final_table))
+
+        for mg in message_groups:
+            if mg.get('error'):
+                self.stdout.write(self.style.ERROR(f'{mg["file"]}: {mg["error"]}'))
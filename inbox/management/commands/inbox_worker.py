@@ -0,0 +1,159 @@
+import logging
+import select
+import signal
+import time
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, close_old_connections
+from django.utils import timezone
+
+from inbox import render
+from inbox.constants import MessageLogStatus
+from inbox.models import Message, MessageLog
+from inbox.utils import process_new_messages, process_new_message_logs, new_messages_batch_size, \
+    new_message_logs_batch_size, parse_shard, filter_shard, aprocess_new_message_logs
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'inbox_worker'
+
+
+class Command(BaseCommand):
+    help = 'Long running worker that processes new messages and message logs as soon as they are due. Under ' \
+           'PostgreSQL it waits on NOTIFY from the insert triggers, otherwise it polls.'
+
+    shard = None
+    stopping = False
+    use_async = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=60,
+                            help='Maximum seconds to wait between checks when nothing is due.')
+        parser.add_argument('--database', default='default',
+                            help='Database alias to LISTEN on.')
+        parser.add_argument('--shard', default=None,
+                            help='Only process Users where user_id %% count == index, given as "index/count".')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Send each batch of message logs concurrently, up to PROCESS_ASYNC_CONCURRENCY.')
+
+    def handle(self, *args, **options):
+        self.poll_interval = options['poll_interval']
+        self.using = options['database']
+        self.use_async = options['use_async']
+
+        try:
+            self.shard = parse_shard(options['shard'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        listen_connection = self.listen()
+
+        try:
+            while not self.stopping:
+                close_old_connections()
+
+                if self.process():
+                    # A full batch was processed, there may be more waiting
+                    continue
+
+                self.wait(listen_connection, self.get_timeout())
+        finally:
+            if listen_connection:
+                listen_connection.close()
+            render.shutdown()
+
+        self.stdout.write('Inbox worker stopped.')
+
+    def stop(self, signum, frame):
+        logger.info(f'Inbox worker received signal {signum}, stopping after the current batch.')
+        self.stopping = True
+
+    def listen(self):
+        wrapper = connections[self.using]
+        if wrapper.vendor != 'postgresql':
+            logger.warning('Inbox worker is not using PostgreSQL, falling back to polling.')
+            return None
+
+        connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        connection.autocommit = True
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+        return connection
+
+    def process(self):
+        """
+        :return: True if either processor filled its batch
+        """
+        processors = (
+            (process_new_messages, new_messages_batch_size),
+            (async_to_sync(aprocess_new_message_logs) if self.use_async else process_new_message_logs,
+             new_message_logs_batch_size),
+        )
+
+        is_full = False
+        for processor, batch_size in processors:
+            limit = batch_size.current
+            try:
+                processed_count = processor(shard=self.shard)
+            except Exception as e:
+                logger.error(f'Inbox worker {batch_size.name} failed: {e}')
+            else:
+                is_full = is_full or processed_count >= limit
+
+        return is_full
+
+    def get_timeout(self):
+        """
+        Seconds until the next Message or MessageLog is due, or a QUEUED MessageLog's lease runs out, bounded by the
+        poll interval, so future send_at values are picked up without a NOTIFY.
+        """
+        next_message_send_at = filter_shard(Message.objects.filter(is_logged=False), self.shard, 'user_id') \
+            .order_by('send_at') \
+            .values_list('send_at', flat=True) \
+            .first()
+        next_message_log_send_at = filter_shard(MessageLog.objects.filter(status=MessageLogStatus.NEW), self.shard,
+                                                'message__user_id') \
+            .order_by('send_at') \
+            .values_list('send_at', flat=True) \
+            .first()
+        next_lease_expiry = filter_shard(MessageLog.objects.filter(status=MessageLogStatus.QUEUED), self.shard,
+                                         'message__user_id') \
+            .order_by('claimed_until') \
+            .values_list('claimed_until', flat=True) \
+            .first()
+
+        timeout = self.poll_interval
+        now = timezone.now()
+        for send_at in (next_message_send_at, next_message_log_send_at, next_lease_expiry):
+            if send_at:
+                # Already due but wasn't processed means another worker has it locked, don't spin on it
+                timeout = min(timeout, max((send_at - now).total_seconds(), 1))
+
+        return timeout
+
+    def wait(self, connection, timeout):
+        deadline = time.monotonic() + timeout
+
+        # Wait in short slices so a stop signal is handled promptly
+        while not self.stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            if connection is None:
+                time.sleep(min(remaining, 1))
+                continue
+
+            if select.select([connection], [], [], min(remaining, 1)) == ([], [], []):
+                continue
+
+            connection.poll()
+            if connection.notifies:
+                del connection.notifies[:]
+                return
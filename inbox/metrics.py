@@ -0,0 +1,204 @@
+"""
+Lightweight instrumentation for the processors, and anything else that wants it:
+
+    with metrics.measure('process_new_message_logs'):
+        with metrics.phase('claim'):
+            ...
+        metrics.increment('email.sent')
+
+Each measured block reports its wall time, query count, per-phase timings and counters to the sinks in METRICS_SINKS
+when it exits. Phases nest, a phase's time excludes any phases inside it. When no sinks are configured nothing is
+collected.
+
+Queries are counted on every database connection while the block is open in the current context, including those of
+the threads sync_to_async runs on since it carries the context over.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.db import connection
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from inbox import settings as inbox_settings
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('inbox_metrics', default=None)
+# One cell per open phase holding the time spent in phases nested inside it, a context var so concurrent tasks each
+# keep their own stack
+_phase_stack = ContextVar('inbox_metrics_phase_stack', default=())
+
+
+class Metrics:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0
+        self.query_count = 0
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def increment(self, key: str, value: int = 1):
+        self.counters[key] += value
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.query_count += 1
+
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs):
+    """
+    connection_created receiver that counts the connection's queries towards the enclosing measure(), if any.
+    """
+    if _count_query not in connection.execute_wrappers:
+        # First so it's outside any execute_wrapper() block, those pop theirs off the end
+        connection.execute_wrappers.insert(0, _count_query)
+
+
+@lru_cache()
+def _load_sink(path):
+    return import_string(path)()
+
+
+def get_sinks():
+    return [_load_sink(path) for path in inbox_settings.get_config()['METRICS_SINKS']]
+
+
+@contextmanager
+def measure(name: str):
+    """
+    Time the block and count its queries, reported to the configured sinks as `name`.
+
+    :return: Metrics for adding counters, or None when no sinks are configured
+    """
+    sinks = get_sinks()
+    if not sinks:
+        yield None
+        return
+
+    metrics = Metrics(name)
+    token = _current.set(metrics)
+    started_at = time.perf_counter()
+
+    # Connections opened before the receiver was connected
+    install_query_counter(connection)
+
+    try:
+        yield metrics
+    finally:
+        metrics.duration = time.perf_counter() - started_at
+        _current.reset(token)
+
+        for sink in sinks:
+            try:
+                sink.emit(metrics)
+            except Exception as e:
+                logger.error(f'Metrics sink {sink.__class__.__name__} failed: {e}')
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time the block as a phase of the enclosing measure(), does nothing outside of one.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+
+    cell = [0.0]
+    token = _phase_stack.set(_phase_stack.get() + (cell,))
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started_at
+        _phase_stack.reset(token)
+
+        metrics.phases[name] += elapsed - cell[0]
+
+        parents = _phase_stack.get()
+        if parents:
+            parents[-1][0] += elapsed
+
+
+def increment(key: str, value: int = 1):
+    """
+    Add to a counter of the enclosing measure(), does nothing outside of one.
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.increment(key, value)
+
+
+class LoggingSink:
+
+    def emit(self, metrics: Metrics):
+        phases = ' '.join(f'{name}={seconds:.3f}s' for name, seconds in sorted(metrics.phases.items()))
+        counters = ' '.join(f'{key}={count}' for key, count in sorted(metrics.counters.items()))
+
+        logger.info(f'{metrics.name} took {metrics.duration:.3f}s with {metrics.query_count} queries'
+                    f'{" phases " + phases if phases else ""}{" counters " + counters if counters else ""}')
+
+
+class PrometheusTextSink:
+    """
+    Accumulates totals in process and renders them in the Prometheus text format, expose them with view_metrics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: [0, 0.0])
+        self._queries = defaultdict(int)
+        self._phases = defaultdict(float)
+        self._counters = defaultdict(int)
+
+    def emit(self, metrics: Metrics):
+        with self._lock:
+            self._durations[metrics.name][0] += 1
+            self._durations[metrics.name][1] += metrics.duration
+            self._queries[metrics.name] += metrics.query_count
+            for name, seconds in metrics.phases.items():
+                self._phases[(metrics.name, name)] += seconds
+            for key, count in metrics.counters.items():
+                self._counters[(metrics.name, key)] += count
+
+    def render(self) -> str:
+        lines = []
+
+        with self._lock:
+            lines += ['# TYPE inbox_duration_seconds summary']
+            for name, (count, seconds) in sorted(self._durations.items()):
+                lines += [f'inbox_duration_seconds_count{{name="{name}"}} {count}',
+                          f'inbox_duration_seconds_sum{{name="{name}"}} {seconds}']
+
+            lines += ['# TYPE inbox_queries_total counter']
+            lines += [f'inbox_queries_total{{name="{name}"}} {count}' for name, count in sorted(self._queries.items())]
+
+            lines += ['# TYPE inbox_phase_seconds_total counter']
+            lines += [f'inbox_phase_seconds_total{{name="{name}",phase="{phase_name}"}} {seconds}'
+                      for (name, phase_name), seconds in sorted(self._phases.items())]
+
+            lines += ['# TYPE inbox_events_total counter']
+            lines += [f'inbox_events_total{{name="{name}",event="{key}"}} {count}'
+                      for (name, key), count in sorted(self._counters.items())]
+
+        return '\n'.join(lines) + '\n'
+
+
+def view_metrics(request):
+    sinks = [sink for sink in get_sinks() if isinstance(sink, PrometheusTextSink)]
+    if not sinks:
+        return HttpResponse(status=404)
+
+    return HttpResponse(''.join(sink.render() for sink in sinks), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.8 on 2026-10-19 09:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0015_auto_20220610_1545'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='inbox_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('read_through_at', models.DateTimeField(blank=True, help_text='When READ_WATERMARK is enabled, Messages sent at or before this are read.', null=True)),
+            ],
+        ),
+    ]
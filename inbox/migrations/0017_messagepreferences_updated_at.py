@@ -0,0 +1,18 @@
+# Generated by Django 5.0.8 on 2026-10-19 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0016_inboxstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagepreferences',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True, verbose_name='Updated'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.0.8 on 2026-10-19 12:05
+
+from django.db import migrations
+
+# Lets inbox_worker wake on inserts, other databases poll instead
+CREATE_SQL = """
+CREATE OR REPLACE FUNCTION inbox_worker_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('inbox_worker', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER inbox_message_insert_notify
+    AFTER INSERT ON inbox_message
+    FOR EACH STATEMENT EXECUTE PROCEDURE inbox_worker_notify();
+
+CREATE TRIGGER inbox_messagelog_insert_notify
+    AFTER INSERT ON inbox_messagelog
+    FOR EACH STATEMENT EXECUTE PROCEDURE inbox_worker_notify();
+"""
+
+DROP_SQL = """
+DROP TRIGGER IF EXISTS inbox_messagelog_insert_notify ON inbox_messagelog;
+DROP TRIGGER IF EXISTS inbox_message_insert_notify ON inbox_message;
+DROP FUNCTION IF EXISTS inbox_worker_notify();
+"""
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SQL)
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0017_messagepreferences_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
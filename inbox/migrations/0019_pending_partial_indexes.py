@@ -0,0 +1,53 @@
+# Generated by Django 5.0.8 on 2026-10-19 13:20
+
+import inbox.constants
+from django.conf import settings
+from django.db import migrations, models
+
+
+class AddIndexConcurrentlyOnPostgres(migrations.AddIndex):
+    """
+    AddIndex, built with CREATE INDEX CONCURRENTLY under PostgreSQL so the table isn't locked while it builds.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.add_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('inbox', '0018_message_insert_notify'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrentlyOnPostgres(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_logged', False)), fields=['send_at', 'user'],
+                               name='inbox_message_unlogged_idx'),
+        ),
+        AddIndexConcurrentlyOnPostgres(
+            model_name='messagelog',
+            index=models.Index(condition=models.Q(('status', inbox.constants.MessageLogStatus(1))),
+                               fields=['send_at', 'message'], name='inbox_messagelog_new_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.8 on 2026-10-19 03:16
+
+import django_enumfield.db.fields
+import inbox.constants
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0019_pending_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediumThrottle',
+            fields=[
+                ('medium', django_enumfield.db.fields.EnumField(enum=inbox.constants.MessageMedium, primary_key=True, serialize=False)),
+                ('next_send_at', models.DateTimeField(help_text='The next free send slot for the medium.')),
+            ],
+        ),
+    ]
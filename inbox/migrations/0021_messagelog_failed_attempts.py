@@ -0,0 +1,18 @@
+# Generated by Django 5.0.8 on 2026-10-19 03:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0020_mediumthrottle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='failed_attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Number of sends that failed, a retried log is back to new with send_at as the next attempt.'),
+        ),
+    ]
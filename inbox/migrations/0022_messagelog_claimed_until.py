@@ -0,0 +1,23 @@
+# Generated by Django 5.0.8 on 2026-10-19 03:20
+
+import inbox.constants
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0021_messagelog_failed_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, help_text='While QUEUED, the lease on the log. If the worker sending it stops before saving the result it is reclaimed after this.', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='messagelog',
+            index=models.Index(condition=models.Q(('status', inbox.constants.MessageLogStatus(2))), fields=['claimed_until'], name='inbox_messagelog_queued_idx'),
+        ),
+    ]
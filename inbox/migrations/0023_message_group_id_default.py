@@ -0,0 +1,19 @@
+# Generated by Django 5.0.8 on 2026-10-19 03:36
+
+import inbox.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0022_messagelog_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='group_id',
+            field=models.CharField(db_index=True, default=inbox.models.get_message_group_default, max_length=255, validators=[inbox.models.validate_group]),
+        ),
+    ]
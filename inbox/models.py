@@ -2,24 +2,27 @@ import inspect
 import json
 import logging
 import os
+import random
 import uuid
+from collections import abc
+from datetime import datetime
 from enum import Enum
-from functools import lru_cache
-from typing import List, Union, Tuple, Set
+from functools import cached_property
+from typing import Iterable, Iterator, Union, Tuple, Set
 
 from annoying.fields import AutoOneToOneField
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from django.core import exceptions
 from django.core.exceptions import ValidationError
 from django.core.mail import EmailMessage
-from django.db import models
-from django.db.models import UniqueConstraint, Q
+from django.core.mail.utils import DNS_NAME
+from django.db import connections, models, transaction
+from django.db.models import UniqueConstraint, Q, F
 from django.db.models.manager import BaseManager
 from django.template import loader, TemplateDoesNotExist
 from django.utils import timezone
-from django.utils.module_loading import import_string
 from django_enumfield import enum
-from jsonschema import validate, exceptions as jsonschema_exceptions
 from toolz import merge
 import django
 
@@ -28,7 +31,9 @@ if django.VERSION >= (3, 1):
 else:
     from django.contrib.postgres.fields import JSONField
 
-from inbox import settings as inbox_settings
+from inbox import settings as inbox_settings, metrics, render
+from inbox.cache import bump_inbox_version
+from inbox.hooks import get_hook
 from inbox.constants import MessageMedium, MessageLogStatus, MessageLogStatusReason
 from inbox.core.app_push.message import AppPushMessage
 from inbox.signals import unread_count, message_preferences_changed
@@ -37,7 +42,6 @@ User = get_user_model()
 logger = logging.getLogger(__name__)
 
 MEDIUMS = ('app_push', 'email', 'sms', 'web_push',)  # TODO Consolidate by using the enum below
-hooks_module = inbox_settings.get_config()['HOOKS_MODULE']
 
 
 class MessageQuerySet(models.QuerySet):
@@ -46,6 +50,24 @@ class MessageQuerySet(models.QuerySet):
         now = timezone.now()
         return self.filter(send_at__lte=now, is_hidden=False, deleted_at__isnull=True, is_logged=True)
 
+    def unread(self):
+        qs = self.filter(read_at__isnull=True)
+
+        if inbox_settings.get_config()['READ_WATERMARK']:
+            qs = qs.filter(Q(user__inbox_state__read_through_at__isnull=True) |
+                           Q(send_at__gt=F('user__inbox_state__read_through_at')))
+
+        return qs
+
+    def with_read_through_at(self):
+        """
+        Annotate each Message with its User's read watermark so `is_read` doesn't need a query per Message.
+        """
+        if not inbox_settings.get_config()['READ_WATERMARK']:
+            return self
+
+        return self.annotate(user_read_through_at=F('user__inbox_state__read_through_at'))
+
 
 class MessageManager(BaseManager.from_queryset(MessageQuerySet)):
 
@@ -66,78 +88,167 @@ class MessageManager(BaseManager.from_queryset(MessageQuerySet)):
 
         return res
 
-    def exists(self, message_ids: Union[Set[str], List[str], str]) -> Tuple[Set[str], Set[str]]:
+    def exists(self, message_ids: Union[Iterable[str], str], user: Union[User, int] = None,
+               chunk_size: int = None) -> Tuple[Set[str], Set[str]]:
+        """
+        Pass it a message id or an iterable of them and it will return the ones that have been sent to and the ones
+        who haven't as sets in a tuple. Message Id order is not guaranteed, duplicates are removed.
+
+        :param user: User instance or user id, only that User's Messages are checked. Message ids are unique per User
+            so pass it when checking a User's ids, the lookup then uses the (user, message_id) unique index.
+        :param chunk_size: message ids per query, defaults to MESSAGE_EXISTS_CHUNK_SIZE
         """
-        Pass it a list or set of message_ids and it will return the ones that have been sent to
-        and the ones who haven't as sets in a tuple. Message Id order is not guaranteed, duplicates are removed.
+        existing_message_ids = set()
+        missing_message_ids = set()
+
+        for existing, missing in self.iter_exists(message_ids, user=user, chunk_size=chunk_size):
+            existing_message_ids |= existing
+            missing_message_ids |= missing
+
+        return existing_message_ids, missing_message_ids
+
+    def iter_exists(self, message_ids: Union[Iterable[str], str], user: Union[User, int] = None,
+                    chunk_size: int = None) -> Iterator[Tuple[Set[str], Set[str]]]:
+        """
+        Same as `exists` but yields (existing, missing) per chunk of message ids as each chunk is queried, so ids can
+        be streamed in and de-duplicated before sending without building the whole result first. Every distinct id is
+        remembered so duplicates are skipped across chunks, memory is O(n) in the number of distinct ids.
         """
-        if not isinstance(message_ids, list):
+        # A single id, as before, may be a str or any other scalar eg a UUID or int
+        if isinstance(message_ids, (str, bytes)) or not isinstance(message_ids, abc.Iterable):
             message_ids = [message_ids]
 
-        message_ids = set(message_ids)
+        chunk_size = chunk_size or inbox_settings.get_config()['MESSAGE_EXISTS_CHUNK_SIZE']
+        max_query_params = connections[self.db].features.max_query_params
+        if max_query_params:
+            # Leave room for the user id
+            chunk_size = min(chunk_size, max_query_params - 1)
 
-        existing_message_ids = set(self.values_list('message_id', flat=True).filter(message_id__in=message_ids))
-        missing_message_ids = message_ids - existing_message_ids
+        queryset = self.get_queryset()
+        if user is not None:
+            queryset = queryset.filter(user_id=getattr(user, 'pk', user))
 
-        return existing_message_ids, missing_message_ids
+        seen = set()
+        chunk = set()
+        for message_id in message_ids:
+            if message_id in seen:
+                continue
+
+            seen.add(message_id)
+            chunk.add(message_id)
+
+            if len(chunk) >= chunk_size:
+                yield self._exists_chunk(queryset, chunk)
+                chunk = set()
+
+        if chunk:
+            yield self._exists_chunk(queryset, chunk)
+
+    @staticmethod
+    def _exists_chunk(queryset, chunk):
+        existing = set(queryset.filter(message_id__in=chunk).values_list('message_id', flat=True))
+
+        return existing, chunk - existing
+
+    def mark_all_read(self, user: Union[User, int] = None, up_to: Union[datetime, int] = None, user_id: int = None):
+        """
+        Mark every unread Message for a User as read.
+
+        :param user: User instance or user id, passing the instance avoids fetching the User again to send out the
+            unread count.
+        :param up_to: datetime or Message id, only Messages sent at or before it are marked read so that Messages
+            arriving after the client rendered its list aren't marked read without being seen. Defaults to now.
+        :param user_id: Deprecated, use `user`.
+        :return: number of Messages marked read. With READ_WATERMARK the rows aren't counted, it's 1 if any were marked
+            read and 0 otherwise.
+        """
+        if user is None:
+            user = user_id
+
+        if isinstance(user, User):
+            user_id = user.pk
+        else:
+            user_id = user
+            user = None
 
-    def mark_all_read(self, user_id: int):
         now = timezone.now()
-        updated_count = self.filter(user_id=user_id, read_at__isnull=True, deleted_at__isnull=True,
-                                    is_hidden=False).update(read_at=now)
+        if up_to is None:
+            up_to = now
+        elif not isinstance(up_to, datetime):
+            up_to = self.filter(user_id=user_id, pk=up_to).values_list('send_at', flat=True).first()
+            if up_to is None:
+                return 0
+
+        up_to = min(up_to, now)
+        messages = self.filter(user_id=user_id, send_at__lte=up_to, deleted_at__isnull=True, is_hidden=False).unread()
+
+        if inbox_settings.get_config()['READ_WATERMARK']:
+            # Messages sent at or before the watermark count as read without touching their rows, or counting them
+            updated_count = int(messages.exists())
+            if updated_count:
+                InboxState.objects.update_or_create(user_id=user_id, defaults={'read_through_at': up_to})
+        else:
+            updated_count = messages.update(read_at=now)
+
+        # Nothing changed so the device is already showing the current count, skip the push entirely
+        if not updated_count:
+            return 0
 
-        if updated_count:
+        bump_inbox_version(user_id)
+
+        if user is None:
             try:
                 user = User.objects.get(pk=user_id)
             except User.DoesNotExist:
-                return
-            else:
-                Message.send_unread_count_app_push(user, 0)
-                unread_count.send(sender=Message, user=user, count=0)
+                return updated_count
+
+        # Anything sent after the watermark is still unread
+        count = 0 if up_to >= now else self.unread_count(user_id)
+
+        Message.send_unread_count_app_push(user, count)
+        unread_count.send(sender=Message, user=user, count=count)
+
+        return updated_count
 
     def unread_count(self, user_id: int):
-        return self.filter(user_id=user_id, send_at__lte=timezone.now(), read_at__isnull=True, deleted_at__isnull=True,
-                           is_hidden=False).count()
+        return self.filter(user_id=user_id, send_at__lte=timezone.now(), deleted_at__isnull=True,
+                           is_hidden=False).unread().count()
 
 
-@lru_cache()
 def get_message_groups():
     return inbox_settings.get_config()['MESSAGE_GROUPS']
 
 
-@lru_cache()
 def get_message_group(id_: str):
-    message_groups = get_message_groups()
+    """
+    :return: the message group, or the default group if there's no longer one with the id
+    """
+    config = inbox_settings.get_config()
+    return config.groups_by_id.get(id_, config.default_group)
 
-    for message_group in message_groups:
-        if message_group['id'] == id_:
-            return message_group
 
-    return None
+def get_message_group_for_key(key: str):
+    """
+    :return: the message group listing the key, or the default group for keys that aren't in one
+    """
+    config = inbox_settings.get_config()
+    return config.groups_by_key.get(key, config.default_group)
 
 
-@lru_cache()
 def is_app_push_enabled():
     """
     If any of the preferences are set to true/false for app_push then it's enabled.
     :return: boolean
     """
-
-    message_groups = get_message_groups()
-
-    for message_group in message_groups:
-        if message_group['preference_defaults']['app_push'] is not None:
-            return True
-
-    return False
+    return 'app_push' in inbox_settings.get_config().enabled_mediums
 
 
 def get_message_group_default():
-    return get_message_groups()[0]['id']
+    return inbox_settings.get_config().default_group['id']
 
 
 def validate_group(value):
-    return value in [message_group['id'] for message_group in get_message_groups()]
+    return value in inbox_settings.get_config().groups_by_id
 
 
 def default_message_id():
@@ -209,6 +320,8 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['-send_at', 'read_at', 'deleted_at', 'is_hidden']),
             models.Index(fields=['send_at']),
+            # Pending Messages for the processors, includes user so sharded workers filter without the table
+            models.Index(fields=['send_at', 'user'], condition=Q(is_logged=False), name='inbox_message_unlogged_idx'),
         ]
         ordering = ('-send_at',)  # This is the default ordering if order_by is not specified on a query
 
@@ -232,7 +345,7 @@ class Message(models.Model):
     message_id = models.CharField(db_index=True, max_length=255, null=True, blank=True,
                                   help_text='Explicitly specifying a message id enables message de-duplication '
                                             'per user.')
-    group_id = models.CharField(db_index=True, default=get_message_group_default(), max_length=255,
+    group_id = models.CharField(db_index=True, default=get_message_group_default, max_length=255,
                                 validators=(validate_group,))
     is_hidden = models.BooleanField(default=False, help_text="There may be cases you want to generate a message so "
                                                              "that it can trigger communication in other channels but "
@@ -248,7 +361,12 @@ class Message(models.Model):
 
     @property
     def is_read(self):
-        return bool(self.read_at)
+        if self.read_at:
+            return True
+
+        read_through_at = self._get_read_through_at()
+
+        return bool(read_through_at and self.send_at <= read_through_at)
 
     @property
     def group(self):
@@ -257,7 +375,7 @@ class Message(models.Model):
         return {
             'id': group['id'],
             'label': group['label'],
-            'data': group['data']
+            'data': inbox_settings.thaw(group['data'])
         }
 
     @property
@@ -267,16 +385,18 @@ class Message(models.Model):
     @is_read.setter
     def is_read(self, value: bool):
         if not value:
+            # Read because of the watermark, it has to be cleared before this Message can be unread
+            if not self.read_at and self.is_read:
+                self._clear_read_through_at = True
             self.read_at = None
         elif not self.read_at:
             self.read_at = timezone.now()
 
     def clean(self):
-        group = self._get_group_from_key()
-        if not group:
+        if self.key not in inbox_settings.get_config().groups_by_key:
             raise ValidationError({'key': [f'"{self.key}" does not exist in any group.']})
         else:
-            self.group_id = group['id']
+            self.group_id = self._get_group_from_key()['id']
 
         subject_template, body_template = self._get_base_templates()
 
@@ -305,8 +425,15 @@ class Message(models.Model):
                 send_unread_count = True
                 perform_maintenance = True
 
+        if getattr(self, '_clear_read_through_at', False):
+            InboxState.objects.clear_read_through_at(self.user_id)
+            self._clear_read_through_at = False
+            self.user_read_through_at = None
+
         super().save(*args, **kwargs)
 
+        bump_inbox_version(self.user_id)
+
         # If the message is in the future we don't need to send the unread count
         if send_unread_count:
             self._send_unread_count()
@@ -317,6 +444,7 @@ class Message(models.Model):
     def delete(self, using=None, keep_parents=False, reason=MessageDeleteReason.SOFT):
         if reason == MessageDeleteReason.FORCE or (reason == MessageDeleteReason.MAINTENANCE and not self.message_id):
             super().delete(using=using, keep_parents=keep_parents)
+            bump_inbox_version(self.user_id)
         else:
             self.deleted_at = timezone.now()
             self.save(using=using)
@@ -325,6 +453,15 @@ class Message(models.Model):
 
         return 1
 
+    def _get_read_through_at(self):
+        if not inbox_settings.get_config()['READ_WATERMARK']:
+            return None
+
+        try:
+            return self.user_read_through_at
+        except AttributeError:
+            return InboxState.objects.filter(user_id=self.user_id).values_list('read_through_at', flat=True).first()
+
     def _get_base_templates(self):
         """
         We have to have at least the base subject and body templates to build the inbox content, if we don't have either
@@ -365,7 +502,8 @@ class Message(models.Model):
 
         template.backend.engine.autoescape = autoescape
         context = self._get_context_for_template()
-        return template.render(context).strip()
+        with render.track_render_queries(self.key):
+            return template.render(context).strip()
 
     def _build_subject(self):
         templates = (
@@ -396,7 +534,7 @@ class Message(models.Model):
 
     def _get_context_for_template(self):
         return {
-            'user': self.user,
+            'user': render.get_template_context_user(self.user),
             'data': self.data,
             'data_email': self.data_email,
             'data_group': self.group
@@ -416,22 +554,13 @@ class Message(models.Model):
         unread_count.send(sender=self.__class__, user=self.user, count=count)
 
     def _get_group_from_key(self):
-        for message_group in get_message_groups():
-            if self.key in message_group['message_keys']:
-                return message_group
-
-        return None
+        return get_message_group_for_key(self.key)
 
     def should_skip_medium(self, medium):
         if medium not in MEDIUMS:
             raise ValueError('Invalid medium')
 
-        message_group = self._get_group_from_key()
-
-        if self.key in message_group[f'skip_{medium}']:
-            return True
-
-        return False
+        return self.key in inbox_settings.get_config().skip_keys[medium]
 
 
 class MessageLog(models.Model):
@@ -444,7 +573,11 @@ class MessageLog(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=['-send_at', 'status']),
-            models.Index(fields=['send_at', 'status'])
+            models.Index(fields=['send_at', 'status']),
+            models.Index(fields=['send_at', 'message'], condition=Q(status=MessageLogStatus.NEW),
+                         name='inbox_messagelog_new_idx'),
+            models.Index(fields=['claimed_until'], condition=Q(status=MessageLogStatus.QUEUED),
+                         name='inbox_messagelog_queued_idx'),
         ]
 
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='logs')
@@ -452,14 +585,31 @@ class MessageLog(models.Model):
     send_at = models.DateTimeField(db_index=True)  # This is from the parent Message
     status = enum.EnumField(MessageLogStatus, default=MessageLogStatus.NEW)
     status_reason = models.TextField(blank=True, null=True)
+    failed_attempts = models.PositiveIntegerField(default=0, help_text='Number of sends that failed, a retried log '
+                                                                        'is back to new with send_at as the next '
+                                                                        'attempt.')
+    claimed_until = models.DateTimeField(blank=True, null=True,
+                                         help_text='While QUEUED, the lease on the log. If the worker sending it '
+                                                   'stops before saving the result it is reclaimed after this.')
     created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Created')
     updated_at = models.DateTimeField(auto_now=True, db_index=True, null=True, verbose_name='Updated')
 
+    # (subject, body) when pre-rendered for the batch, see inbox.render
+    rendered = None
+
+    @property
+    def idempotency_key(self):
+        """
+        Stable for the life of the log, so a send resumed after a crash can be recognised by backends that support it.
+        """
+        return f'inbox-message-log-{self.pk}'
+
     @property
     def is_send_at_in_range(self):
         max_age_beyond_send_at = inbox_settings.get_config()['MAX_AGE_BEYOND_SEND_AT']
         if max_age_beyond_send_at:
-            max_age = self.send_at + max_age_beyond_send_at
+            # From the Message, the log's own send_at moves on when it's retried or rate limited
+            max_age = self.message.send_at + max_age_beyond_send_at
 
             if timezone.now() > max_age:
                 self.status = MessageLogStatus.NOT_SENDABLE
@@ -486,11 +636,7 @@ class MessageLog(models.Model):
     def can_send(self):
         user = self.message.user
 
-        can_send_hook = None
-        try:
-            can_send_hook = import_string(f'{hooks_module}.{self.message.key}.can_send')
-        except (ImportError, ModuleNotFoundError) as e:
-            pass
+        can_send_hook = get_hook(self.message.key, 'can_send')
 
         if can_send_hook:
             can_send = bool(can_send_hook(self))
@@ -499,11 +645,7 @@ class MessageLog(models.Model):
             return can_send
 
         if self.medium == MessageMedium.APP_PUSH:
-            can_send_hook = None
-            try:
-                can_send_hook = import_string(f'{hooks_module}.{self.message.key}.can_send_app_push')
-            except (ImportError, ModuleNotFoundError) as e:
-                pass
+            can_send_hook = get_hook(self.message.key, 'can_send_app_push')
 
             if can_send_hook:
                 can_send = bool(can_send_hook(self))
@@ -517,11 +659,7 @@ class MessageLog(models.Model):
                 return False
 
         if self.medium == MessageMedium.EMAIL:
-            can_send_hook = None
-            try:
-                can_send_hook = import_string(f'{hooks_module}.{self.message.key}.can_send_email')
-            except (ImportError, ModuleNotFoundError) as e:
-                pass
+            can_send_hook = get_hook(self.message.key, 'can_send_email')
 
             if can_send_hook:
                 can_send = bool(can_send_hook(self))
@@ -535,11 +673,7 @@ class MessageLog(models.Model):
                 return False
 
         if self.medium == MessageMedium.SMS:
-            can_send_hook = None
-            try:
-                can_send_hook = import_string(f'{hooks_module}.{self.message.key}.can_send_sms')
-            except (ImportError, ModuleNotFoundError) as e:
-                pass
+            can_send_hook = get_hook(self.message.key, 'can_send_sms')
 
             if can_send_hook:
                 can_send = bool(can_send_hook(self))
@@ -560,12 +694,50 @@ class MessageLog(models.Model):
 
         return True
 
+    def retry_or_fail(self, reason: str = None):
+        """
+        Record a failed send, if retries remain the log goes back in the queue after an exponential backoff, otherwise
+        it's failed for good.
+        """
+        config = inbox_settings.get_config()
+
+        self.failed_attempts += 1
+        self.status_reason = reason
+
+        if self.failed_attempts > config['MESSAGE_LOG_MAX_RETRIES']:
+            self.status = MessageLogStatus.FAILED
+            return
+
+        backoff = min(config['MESSAGE_LOG_RETRY_BACKOFF'] * 2 ** (self.failed_attempts - 1),
+                      config['MESSAGE_LOG_RETRY_BACKOFF_MAX'])
+        # Jitter so logs that failed together, eg during a provider outage, don't all retry together
+        backoff *= random.uniform(1, 1.25)
+
+        self.status = MessageLogStatus.NEW
+        self.send_at = timezone.now() + backoff
+
     def send(self):
         if self.medium == MessageMedium.APP_PUSH:
             self.send_push_notification()
         if self.medium == MessageMedium.EMAIL:
             self.send_email()
 
+    async def async_send(self):
+        """
+        Async counterpart of send(). App push goes through the backend's async_send_messages, Django has no async
+        email transport so the email is built on the thread sensitive executor, like other ORM access, and only
+        handed to the connection from a worker thread.
+        """
+        if self.medium == MessageMedium.APP_PUSH:
+            subject = await sync_to_async(self._build_subject)()
+            body = await sync_to_async(self._build_body)()
+
+            await AppPushMessage(self.message.user, subject, body, data=self.message.data,
+                                 message_log=self).async_send()
+        if self.medium == MessageMedium.EMAIL:
+            msg = await sync_to_async(self._build_email)()
+            await sync_to_async(self._deliver_email, thread_sensitive=False)(msg)
+
     def send_push_notification(self):
         subject = self._build_subject()
         body = self._build_body()
@@ -573,6 +745,9 @@ class MessageLog(models.Model):
         AppPushMessage(self.message.user, subject, body, data=self.message.data, message_log=self).send()
 
     def send_email(self):
+        self._deliver_email(self._build_email())
+
+    def _build_email(self):
         subject = self._build_subject()
         body = self._build_body()
 
@@ -582,11 +757,17 @@ class MessageLog(models.Model):
         msg = EmailMessage(subject, body,
                            to=[self.message.user.email],
                            headers={
+                               # A resumed send reuses the Message-ID so receiving servers can drop the duplicate
+                               'Message-ID': f'<{self.idempotency_key}@{DNS_NAME}>',
                                'X-MC-Tags': self.message.key,
                                'X-SMTPAPI': f'{{"category": "{self.message.key}"}}',
                                'X-Mailgun-Tag': self.message.key
                            })
         msg.content_subtype = "html"
+
+        return msg
+
+    def _deliver_email(self, msg):
         try:
             msg.send()
         except Exception as e:
@@ -597,7 +778,7 @@ class MessageLog(models.Model):
 
     def _get_context_for_template(self):
         return {
-            'user': self.message.user,
+            'user': render.get_template_context_user(self.message.user),
             'data': self.message.data,
             'data_email': self.message.data_email,
             'data_group': self.message.group
@@ -622,20 +803,27 @@ class MessageLog(models.Model):
         return template_names
 
     def _build_subject(self):
+        if self.rendered:
+            return self.rendered[0]
+
+        with metrics.phase('render'):
+            return self.render_subject(self.message.key, self.medium, self._get_context_for_template())
+
+    @classmethod
+    def render_subject(cls, key: str, medium: MessageMedium, context: dict):
         try:
-            template = loader.select_template(self._get_subject_template_names(self.message.key, self.medium))
+            template = loader.select_template(cls._get_subject_template_names(key, medium))
         except TemplateDoesNotExist:
-            raise ValidationError({'key': [f'Subject template for "{self.message.key}/{self.medium.name.lower()}" '
+            raise ValidationError({'key': [f'Subject template for "{key}/{medium.name.lower()}" '
                                            f'does not exist.']})
 
-        context = self._get_context_for_template()
-
         autoescape = True
         if template.origin.template_name.endswith('txt'):
             autoescape = False
 
         template.backend.engine.autoescape = autoescape
-        subject = template.render(context)
+        with render.track_render_queries(key):
+            subject = template.render(context)
 
         if inbox_settings.get_config()['TESTING_MEDIUM_OUTPUT_PATH']:
             from inbox.test.utils import dump_template
@@ -672,18 +860,26 @@ class MessageLog(models.Model):
         return template_names
 
     def _build_body(self):
+        if self.rendered:
+            return self.rendered[1]
+
+        with metrics.phase('render'):
+            return self.render_body(self.message.key, self.medium, self._get_context_for_template())
+
+    @classmethod
+    def render_body(cls, key: str, medium: MessageMedium, context: dict):
         try:
-            template = loader.select_template(self._get_body_template_names(self.message.key, self.medium))
+            template = loader.select_template(cls._get_body_template_names(key, medium))
         except TemplateDoesNotExist:
-            raise ValidationError({'key': [f'Body template for "{self.message.key}/{self.medium.name.lower()}" does not exist.']})
+            raise ValidationError({'key': [f'Body template for "{key}/{medium.name.lower()}" does not exist.']})
 
         autoescape = True
         if template.origin.template_name.endswith('txt'):
             autoescape = False
 
-        context = self._get_context_for_template()
         template.backend.engine.autoescape = autoescape
-        body = template.render(context)
+        with render.track_render_queries(key):
+            body = template.render(context)
 
         if inbox_settings.get_config()['TESTING_MEDIUM_OUTPUT_PATH']:
             from inbox.test.utils import dump_template
@@ -693,13 +889,41 @@ class MessageLog(models.Model):
 
 
 # TODO Move to own django lib
+PREFERENCE_MEDIUM_KEYS = frozenset(('app_push', 'email', 'sms', 'web_push'))
+
+
+def is_valid_message_preference_groups(value) -> bool:
+    """
+    Same as validating against message_preference_groups.schema.json, without jsonschema.
+    """
+    if type(value) is not list or not value:
+        return False
+
+    for preference in value:
+        if type(preference) is not dict or type(preference.get('id')) is not str:
+            return False
+
+        for k, v in preference.items():
+            if k != 'id' and (k not in PREFERENCE_MEDIUM_KEYS or type(v) is not bool):
+                return False
+
+    return True
+
+
+# Schema file to a plain Python check of valid values, only invalid values are validated with jsonschema to get its
+# error message
+FAST_SCHEMA_VALIDATORS = {
+    'message_preference_groups.schema.json': is_valid_message_preference_groups,
+}
+
+
 class JSONSchemaField(JSONField):
 
     def __init__(self, *args, **kwargs):
         self.schema = kwargs.pop('schema', None)
         super().__init__(*args, **kwargs)
 
-    @property
+    @cached_property
     def _schema_data(self):
         model_file = inspect.getfile(self.model)
         dirname = os.path.dirname(model_file)
@@ -713,6 +937,14 @@ class JSONSchemaField(JSONField):
         # Disable validation when migrations are faked
         if self.model.__module__ == '__fake__':
             return True
+
+        fast_validator = FAST_SCHEMA_VALIDATORS.get(self.schema)
+        if fast_validator and fast_validator(value):
+            return None
+
+        # Imported when needed, it's slow to import and the fast validators cover valid values
+        from jsonschema import validate, exceptions as jsonschema_exceptions
+
         try:
             status = validate(value, self._schema_data)
         except jsonschema_exceptions.ValidationError as e:
@@ -731,36 +963,17 @@ class JSONSchemaField(JSONField):
 
 
 def get_default_preference_ids():
-    return [dp['id'] for dp in get_default_preferences()]
-
-
-def _get_props(message_group, include_all_keys):
-
-    d = {'id': message_group['id']}
-    if include_all_keys:
-        d.update({
-            'label': message_group['label'],
-            'description': message_group['description'],
-            'data': message_group['data']
-        })
-
-    return d
+    return [dp['id'] for dp in inbox_settings.get_config().default_preferences]
 
 
 def get_default_preferences(include_all_keys=False):
-    message_groups_with_preference = filter(lambda message_group: message_group['is_preference'], get_message_groups())
+    default_preferences = inbox_settings.get_config().default_preferences
 
-    default_preferences = [{**_get_props(mg, include_all_keys),
-                            **mg['preference_defaults']} for mg in message_groups_with_preference]
-
-    # Remove any null mediums, they are disabled
-    for k, default_preference in enumerate(default_preferences):
-        default_preferences[k] = {k: v for k, v in default_preference.items() if k in ('id',
-                                                                                       'label',
-                                                                                       'description',
-                                                                                       'data') or v is not None}
+    if include_all_keys:
+        return [inbox_settings.thaw(default_preference) for default_preference in default_preferences]
 
-    return default_preferences
+    return [{k: v for k, v in default_preference.items() if k not in ('label', 'description', 'data')}
+            for default_preference in default_preferences]
 
 
 def reconcile_default_preferences(preferences):
@@ -877,6 +1090,7 @@ class MessagePreferences(models.Model):
 
     _groups = JSONSchemaField(blank=True, db_index=True, null=True, default=get_default_preferences,
                               db_column='groups', schema='message_preference_groups.schema.json')
+    updated_at = models.DateTimeField(auto_now=True, null=True, verbose_name='Updated')
 
     @property
     def groups(self):
@@ -936,3 +1150,46 @@ class MessagePreferences(models.Model):
                 changed_message_preferences.append(new_group)
 
         return changed_message_preferences
+
+
+class InboxStateManager(models.Manager):
+
+    def clear_read_through_at(self, user_id: int):
+        """
+        Write the read watermark onto every unread Message it covers and then remove it, this is only needed when a
+        Message sent before the watermark is marked unread again.
+        """
+        with transaction.atomic():
+            inbox_state = self.select_for_update().filter(user_id=user_id).first()
+
+            if not inbox_state or not inbox_state.read_through_at:
+                return
+
+            Message.objects.filter(user_id=user_id, send_at__lte=inbox_state.read_through_at,
+                                   read_at__isnull=True).update(read_at=inbox_state.read_through_at)
+
+            inbox_state.read_through_at = None
+            inbox_state.save(update_fields=['read_through_at'])
+
+            bump_inbox_version(user_id)
+
+
+class InboxState(models.Model):
+    """
+    Per user inbox bookkeeping, lets inbox wide changes be a single row write rather than touching every Message.
+    """
+    objects = InboxStateManager()
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='inbox_state')
+    read_through_at = models.DateTimeField(blank=True, null=True,
+                                           help_text='When READ_WATERMARK is enabled, Messages sent at or before this '
+                                                     'are read.')
+
+
+class MediumThrottle(models.Model):
+    """
+    Shared pacing for MAX_SENDS_PER_SECOND, each send reserves the next slot for its medium so workers stay under the
+    provider's quota together. See inbox.throttle.
+    """
+    medium = enum.EnumField(MessageMedium, primary_key=True)
+    next_send_at = models.DateTimeField(help_text='The next free send slot for the medium.')
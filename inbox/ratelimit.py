@@ -0,0 +1,60 @@
+"""
+Per user, per medium fixed window counter so a misbehaving caller can't flood a single device or inbox. Limits are set
+per medium with RATE_LIMITS and can be overridden per message group with `rate_limits`, eg:
+
+    "RATE_LIMITS": {
+        "app_push": {"rate": 10, "per": timedelta(minutes=1)},
+    }
+
+allows 10 app pushes per User in each minute. Counters are kept in the Django cache named by RATE_LIMIT_CACHE and
+taken with add and incr, so workers sharing the cache count together. Use a cache where incr is atomic, eg Redis,
+Memcached or locmem within a process.
+"""
+import time
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.utils import timezone
+
+from inbox import settings as inbox_settings
+
+
+def get_rate_limit(message_group, medium: str):
+    rate_limits = message_group.get('rate_limits') or {}
+    if medium in rate_limits:
+        return rate_limits[medium]
+
+    return inbox_settings.get_config()['RATE_LIMITS'].get(medium)
+
+
+def acquire(user_id, medium: str, message_group):
+    """
+    Count a send against the User's current window for the medium.
+
+    :return: None if the send can go ahead, otherwise the datetime to retry at, when the next window starts
+    """
+    rate_limit = get_rate_limit(message_group, medium)
+    if not rate_limit:
+        return None
+
+    per_seconds = rate_limit['per'].total_seconds()
+
+    now = time.time()
+    window_start = now - now % per_seconds
+    cache = caches[inbox_settings.get_config()['RATE_LIMIT_CACHE']]
+    key = f'inbox:rate_limit:{user_id}:{medium}:{int(window_start)}'
+
+    # Kept a second past the window's end, after that a new window has its own key
+    timeout = int(window_start + per_seconds - now) + 1
+    cache.add(key, 0, timeout)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        cache.add(key, 1, timeout)
+        count = 1
+
+    if count <= rate_limit['rate']:
+        return None
+
+    return timezone.now() + timedelta(seconds=window_start + per_seconds - now)
@@ -0,0 +1,198 @@
+"""
+Template context and rendering support.
+
+With TEMPLATE_CONTEXT_USER_FIELDS set templates get those User fields as `user` rather than the User instance, so they
+can't lazily query related objects per message. Relations templates do need are loaded for the whole batch with
+TEMPLATE_CONTEXT_USER_SELECT_RELATED and TEMPLATE_CONTEXT_USER_PREFETCH_RELATED, TEMPLATE_CONTEXT_DEBUG reports the
+queries that still happen while rendering.
+
+PROCESS_RENDER_POOL_SIZE enables a render stage that pre-renders subjects and bodies for a claimed batch of message
+logs in a process pool, so CPU bound template rendering isn't competing with database and network work on one core.
+Only primitive context crosses the process boundary: the User fields in TEMPLATE_CONTEXT_USER_FIELDS, data, data_email
+and the message group. The pool needs TEMPLATE_CONTEXT_USER_FIELDS set so templates see the same `user` whether or not
+they're pre-rendered.
+"""
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections
+
+from inbox import settings as inbox_settings
+from inbox.constants import MessageMedium
+
+logger = logging.getLogger(__name__)
+
+RENDERED_MEDIUMS = (MessageMedium.APP_PUSH, MessageMedium.EMAIL)
+
+_executor = None
+
+# Message key to {'renders': n, 'queries': n}, filled while TEMPLATE_CONTEXT_DEBUG is on
+query_report = defaultdict(lambda: {'renders': 0, 'queries': 0})
+
+
+def _init_worker():
+    import django
+    from django.apps import apps
+
+    # Already set up when the pool forks, not when it spawns
+    if not apps.ready:
+        django.setup()
+        return
+
+    # A forked worker inherits the parent's connections, closing them would end the parent's sessions on the shared
+    # sockets so they're dropped instead, a template that queries opens the worker's own
+    for inherited in connections.all():
+        inherited.connection = None
+
+
+def _render(key, medium, context):
+    from inbox.models import MessageLog
+
+    return MessageLog.render_subject(key, medium, context), MessageLog.render_body(key, medium, context)
+
+
+def get_executor():
+    global _executor
+
+    config = inbox_settings.get_config()
+    pool_size = config['PROCESS_RENDER_POOL_SIZE']
+    if not pool_size:
+        return None
+
+    if config['TEMPLATE_CONTEXT_USER_FIELDS'] is None:
+        raise ImproperlyConfigured('PROCESS_RENDER_POOL_SIZE requires TEMPLATE_CONTEXT_USER_FIELDS, templates '
+                                   'rendered in the pool are given those User fields rather than the User')
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=pool_size, initializer=_init_worker)
+
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def get_user_context(user, fields=None):
+    """
+    :param fields: attribute names, dotted for related objects eg "profile.nickname", callables are called
+    """
+    if fields is None:
+        fields = inbox_settings.get_config()['TEMPLATE_CONTEXT_USER_FIELDS']
+    if fields is None:
+        fields = [field.attname for field in user._meta.concrete_fields
+                  if not field.is_relation and field.attname != 'password']
+
+    context = {}
+    for field in fields:
+        parts = field.split('.')
+
+        value = user
+        for part in parts:
+            if value is None:
+                break
+            value = getattr(value, part, None)
+            if callable(value):
+                value = value()
+
+        target = context
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+
+    return context
+
+
+def get_template_context_user(user):
+    if inbox_settings.get_config()['TEMPLATE_CONTEXT_USER_FIELDS'] is None:
+        return user
+
+    return get_user_context(user)
+
+
+def get_user_relations(prefix: str):
+    """
+    :param prefix: path from the model being queried to the User, eg "message__user__"
+    :return: (select_related, prefetch_related)
+    """
+    config = inbox_settings.get_config()
+
+    return ([f'{prefix}{relation}' for relation in config['TEMPLATE_CONTEXT_USER_SELECT_RELATED']],
+            [f'{prefix}{relation}' for relation in config['TEMPLATE_CONTEXT_USER_PREFETCH_RELATED']])
+
+
+def get_context(message_log):
+    message = message_log.message
+
+    return {
+        'user': get_user_context(message.user),
+        'data': message.data,
+        'data_email': message.data_email,
+        'data_group': message.group
+    }
+
+
+def prerender_message_logs(message_logs):
+    """
+    Set MessageLog.rendered for each log that renders in the pool. A log that fails to render is left to render again
+    when it's sent so the failure is recorded on the log the usual way.
+    """
+    executor = get_executor()
+    if executor is None:
+        return
+
+    futures = [
+        (message_log, executor.submit(_render, message_log.message.key, message_log.medium, get_context(message_log)))
+        for message_log in message_logs
+        if message_log.medium in RENDERED_MEDIUMS
+    ]
+
+    for message_log, future in futures:
+        try:
+            message_log.rendered = future.result()
+        except Exception as e:
+            logger.warning(f'MessageLog {message_log.pk} failed to pre-render: {e}')
+
+
+@contextmanager
+def track_render_queries(key: str):
+    """
+    With TEMPLATE_CONTEXT_DEBUG on, count the queries a render issues against its message key, these are usually
+    templates reaching User relations that aren't in TEMPLATE_CONTEXT_USER_SELECT_RELATED / PREFETCH_RELATED.
+    """
+    if not inbox_settings.get_config()['TEMPLATE_CONTEXT_DEBUG']:
+        yield
+        return
+
+    queries = []
+
+    def execute_wrapper(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(execute_wrapper):
+        yield
+
+    query_report[key]['renders'] += 1
+    query_report[key]['queries'] += len(queries)
+
+    for sql in queries:
+        logger.debug(f'Rendering {key} issued: {sql}')
+
+
+def log_query_report():
+    """
+    Log and reset the queries per message key since the last report.
+    """
+    for key, report in sorted(query_report.items()):
+        if report['queries']:
+            logger.warning(f'Rendering {key} issued {report["queries"]} queries over {report["renders"]} renders')
+
+    query_report.clear()
@@ -3,7 +3,13 @@ from rest_framework import serializers
 from inbox import settings as inbox_settings
 from inbox.models import Message
 
-MESSAGE_GROUPS = inbox_settings.get_config()['MESSAGE_GROUPS']
+
+def __getattr__(name):
+    # MESSAGE_GROUPS follows the current config rather than the one at import
+    if name == 'MESSAGE_GROUPS':
+        return inbox_settings.get_config()['MESSAGE_GROUPS']
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 class MessageListSerializer(serializers.ModelSerializer):
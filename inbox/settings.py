@@ -1,4 +1,9 @@
+import hashlib
+import json
+from collections.abc import Mapping
+from datetime import timedelta
 from functools import lru_cache
+from types import MappingProxyType
 
 from django.conf import settings
 
@@ -19,6 +24,7 @@ MESSAGE_GROUP_FILL = {
     "skip_email": [],
     "skip_web_push": [],
     "skip_sms": [],
+    "rate_limits": {},
 }
 
 CONFIG_DEFAULTS = {
@@ -43,18 +49,43 @@ CONFIG_DEFAULTS = {
             "PROJECT_ID": 12345,
             "ENV": "app_engine",  # 'app_engine' or None
         },
+        "MAX_SENDS_PER_SECOND": {},
     },
     "TESTING_MEDIUM_OUTPUT_PATH": None,
     "DISABLE_NEW_DATA_SILENT_APP_PUSH": False,
     "MESSAGE_CREATE_FAIL_SILENTLY": True,
+    "MESSAGE_EXISTS_CHUNK_SIZE": 5000,
     "HOOKS_MODULE": None,
     "PROCESS_NEW_MESSAGES_LIMIT": 25,
     "PROCESS_NEW_MESSAGE_LOGS_LIMIT": 25,
+    "PROCESS_BATCH_TARGET_DURATION": None,
+    "PROCESS_BATCH_MAX_LIMIT": 500,
+    "PROCESS_DRAIN_DEADLINE": None,
+    "PROCESS_ASYNC_CONCURRENCY": 100,
+    "PROCESS_LOGS_SELECT_RELATED": ["message__user__message_preferences"],
+    "PROCESS_LOGS_PREFETCH_RELATED": [],
+    "PROCESS_RENDER_POOL_SIZE": None,
+    "TEMPLATE_CONTEXT_USER_FIELDS": None,
+    "TEMPLATE_CONTEXT_USER_SELECT_RELATED": [],
+    "TEMPLATE_CONTEXT_USER_PREFETCH_RELATED": [],
+    "TEMPLATE_CONTEXT_DEBUG": False,
+    "METRICS_SINKS": [],
+    "MESSAGE_LOG_MAX_RETRIES": 5,
+    "MESSAGE_LOG_RETRY_BACKOFF": timedelta(seconds=30),
+    "MESSAGE_LOG_RETRY_BACKOFF_MAX": timedelta(hours=1),
+    "MESSAGE_LOG_LEASE": timedelta(minutes=5),
     "PER_USER_MESSAGES_MAX_AGE": None,
     "PER_USER_MESSAGES_MIN_COUNT": None,
     "PER_USER_MESSAGES_MAX_COUNT": None,
     "PER_USER_MESSAGES_MIN_AGE": None,
     "MAX_AGE_BEYOND_SEND_AT": None,
+    "READ_WATERMARK": False,
+    "MESSAGES_LIST_CACHE": None,
+    "MESSAGES_LIST_CACHE_TIMEOUT": 300,
+    "STREAM_BACKEND": None,
+    "STREAM_HEARTBEAT_INTERVAL": 15,
+    "RATE_LIMITS": {},
+    "RATE_LIMIT_CACHE": "default",
 }
 
 
@@ -77,13 +108,118 @@ def deep_merge(a, b):
     return dict(pairs)
 
 
+def freeze(value):
+    """Read only copy of a config value, dicts become mappingproxies and lists tuples, all the way down."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Plain dicts and lists back from a frozen config value, eg for serializing it."""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+MEDIUMS = ("app_push", "email", "sms", "web_push")
+
+
+class Config(Mapping):
+    """
+    The merged INBOX_CONFIG, frozen all the way down, along with lookup tables built from the message groups once so
+    callers don't scan MESSAGE_GROUPS on every call:
+
+    - groups_by_id: group id to message group, the first group wins if an id is repeated
+    - groups_by_key: message key to the first message group that lists it
+    - skip_keys: medium to the keys that skip it in their group
+    - group_mediums: group id to the mediums its messages are logged for, those not None in preference_defaults
+    - enabled_mediums: mediums logged by any group
+    - default_group: the first message group
+    - default_preferences: the preference of each group that is a preference, as returned by get_default_preferences
+    - message_groups_digest: hash of MESSAGE_GROUPS, changes whenever the groups do
+
+    A Config compares equal to the plain dicts and lists it was built from.
+    """
+
+    def __init__(self, user_config):
+        config = CONFIG_DEFAULTS.copy()
+        config.update(user_config)
+
+        # Merged into new dicts so the INBOX_CONFIG setting itself is left as it was
+        config["MESSAGE_GROUPS"] = [deep_merge(MESSAGE_GROUP_FILL, message_group)
+                                    for message_group in config["MESSAGE_GROUPS"]]
+        self._config = {k: freeze(v) for k, v in config.items()}
+        message_groups = self._config["MESSAGE_GROUPS"]
+
+        groups_by_id = {}
+        groups_by_key = {}
+        for message_group in message_groups:
+            groups_by_id.setdefault(message_group["id"], message_group)
+            for key in message_group["message_keys"]:
+                groups_by_key.setdefault(key, message_group)
+
+        self.groups_by_id = MappingProxyType(groups_by_id)
+        self.groups_by_key = MappingProxyType(groups_by_key)
+        self.skip_keys = MappingProxyType({
+            medium: frozenset(key for key, message_group in groups_by_key.items()
+                              if key in message_group[f"skip_{medium}"])
+            for medium in MEDIUMS
+        })
+        self.group_mediums = MappingProxyType({
+            message_group["id"]: tuple(medium for medium, default in message_group["preference_defaults"].items()
+                                       if default is not None)
+            for message_group in groups_by_id.values()
+        })
+        self.enabled_mediums = frozenset(medium for mediums in self.group_mediums.values() for medium in mediums)
+        self.default_group = message_groups[0] if message_groups else None
+        self.default_preferences = tuple(
+            MappingProxyType({
+                "id": message_group["id"],
+                "label": message_group.get("label"),
+                "description": message_group.get("description"),
+                "data": message_group["data"],
+                **{medium: default for medium, default in message_group["preference_defaults"].items()
+                   if default is not None},
+            })
+            for message_group in message_groups if message_group["is_preference"]
+        )
+        self.message_groups_digest = hashlib.md5(
+            json.dumps(thaw(message_groups), sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def __getitem__(self, key):
+        return self._config[key]
+
+    def __iter__(self):
+        return iter(self._config)
+
+    def __len__(self):
+        return len(self._config)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return thaw(self) == thaw(other)
+
+
 @lru_cache()
-def get_config():
-    USER_CONFIG = getattr(settings, "INBOX_CONFIG", {})
-    CONFIG = CONFIG_DEFAULTS.copy()
-    CONFIG.update(USER_CONFIG)
+def get_config() -> Config:
+    return Config(getattr(settings, "INBOX_CONFIG", {}))
+
+
+def reload() -> Config:
+    """
+    Rebuild the config from the INBOX_CONFIG setting, done automatically when the setting is overridden in tests.
+    """
+    get_config.cache_clear()
+    return get_config()
 
-    for k, message_group in enumerate(CONFIG["MESSAGE_GROUPS"]):
-        CONFIG["MESSAGE_GROUPS"][k] = deep_merge(MESSAGE_GROUP_FILL, message_group)
 
-    return CONFIG
+def setting_changed_receiver(setting, **kwargs):
+    if setting == "INBOX_CONFIG":
+        reload()
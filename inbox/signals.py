@@ -5,3 +5,6 @@ unread_count = django.dispatch.Signal()
 
 # Arguments: user, delta
 message_preferences_changed = django.dispatch.Signal()
+
+# Arguments: user, message
+new_message = django.dispatch.Signal()
@@ -0,0 +1,185 @@
+"""
+Queue health and the template audit for `inbox_status`.
+
+Pending counts and lag come from the partial indexes on unlogged Messages and new and queued MessageLogs, which only
+hold the queue rather than the history, throughput counts recent rows by `updated_at`.
+
+Templates are checked against an index of the names the configured loaders can find, listed once from their
+directories rather than loading every candidate, `compile_templates` optionally checks their syntax in a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Count
+from django.template import engines, loader, TemplateDoesNotExist, TemplateSyntaxError
+from django.template.backends.django import DjangoTemplates
+from django.template.loaders import cached, filesystem, locmem
+from django.utils import timezone
+
+from inbox import render
+from inbox.constants import MessageLogStatus, MessageMedium
+from inbox.models import Message, MessageLog
+
+DEFAULT_WINDOWS = (timedelta(minutes=1), timedelta(minutes=5), timedelta(hours=1))
+
+
+def get_estimated_count(model):
+    """
+    :return: the planner's row estimate under PostgreSQL, otherwise None rather than a full count
+    """
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+
+    return max(row[0], 0) if row else None
+
+
+def _by_medium(queryset):
+    counts = {medium: 0 for medium in MessageMedium.keys()}
+    for row in queryset.values('medium').annotate(count=Count('pk')).order_by():
+        counts[MessageMedium.get(row['medium']).name.lower()] = row['count']
+
+    return counts
+
+
+def _lag(oldest_send_at, now):
+    return (now - oldest_send_at).total_seconds() if oldest_send_at else 0
+
+
+def get_queue_status(now=None, windows=DEFAULT_WINDOWS):
+    """
+    :param windows: timedeltas to report throughput over
+    :return: dict of plain values, ready to serialize to JSON
+    """
+    now = now or timezone.now()
+
+    unlogged_messages = Message.objects.filter(is_logged=False)
+    oldest_message_send_at = unlogged_messages.filter(send_at__lte=now).order_by('send_at') \
+        .values_list('send_at', flat=True).first()
+
+    new_message_logs = MessageLog.objects.filter(status=MessageLogStatus.NEW)
+    oldest_message_log_send_at = new_message_logs.filter(send_at__lte=now).order_by('send_at') \
+        .values_list('send_at', flat=True).first()
+
+    queued_message_logs = MessageLog.objects.filter(status=MessageLogStatus.QUEUED)
+
+    throughput = []
+    for window in sorted(windows):
+        seconds = window.total_seconds()
+        counts = {status: {medium: 0 for medium in MessageMedium.keys()} for status in ('sent', 'failed')}
+
+        rows = MessageLog.objects \
+            .filter(updated_at__gte=now - window, status__in=[MessageLogStatus.SENT, MessageLogStatus.FAILED]) \
+            .values('medium', 'status').annotate(count=Count('pk')).order_by()
+        for row in rows:
+            status = MessageLogStatus.get(row['status']).name.lower()
+            counts[status][MessageMedium.get(row['medium']).name.lower()] = row['count']
+
+        throughput.append({
+            'window_seconds': seconds,
+            'sent': counts['sent'],
+            'failed': counts['failed'],
+            'sent_per_second': {medium: count / seconds for medium, count in counts['sent'].items()},
+        })
+
+    return {
+        'now': now.isoformat(),
+        'messages': {
+            'unlogged': unlogged_messages.count(),
+            'oldest_due_send_at': oldest_message_send_at.isoformat() if oldest_message_send_at else None,
+            'lag_seconds': _lag(oldest_message_send_at, now),
+            'estimated_total': get_estimated_count(Message),
+        },
+        'message_logs': {
+            'new': _by_medium(new_message_logs),
+            'queued': _by_medium(queued_message_logs),
+            'expired_claims': queued_message_logs.filter(claimed_until__lt=now).count(),
+            'oldest_due_send_at': oldest_message_log_send_at.isoformat() if oldest_message_log_send_at else None,
+            'lag_seconds': _lag(oldest_message_log_send_at, now),
+            'estimated_total': get_estimated_count(MessageLog),
+        },
+        'throughput': throughput,
+    }
+
+
+def _index_loader(template_loader, prefix, names):
+    """
+    :return: False if the loader's templates can't be listed
+    """
+    if isinstance(template_loader, cached.Loader):
+        return all([_index_loader(child, prefix, names) for child in template_loader.loaders])
+
+    if isinstance(template_loader, locmem.Loader):
+        names.update(name for name in template_loader.templates_dict if name.startswith(prefix))
+        return True
+
+    # Includes the app directories loader
+    if isinstance(template_loader, filesystem.Loader):
+        for directory in template_loader.get_dirs():
+            directory = str(directory)
+            for dirpath, dirnames, filenames in os.walk(os.path.join(directory, prefix)):
+                for filename in filenames:
+                    names.add(os.path.relpath(os.path.join(dirpath, filename), directory).replace(os.sep, '/'))
+        return True
+
+    return False
+
+
+def get_template_index(prefix='inbox/'):
+    """
+    :return: (names, complete) the template names under `prefix` the configured loaders can find, complete is False
+        when a loader or engine couldn't be listed, names missing from the index then need checking with the loader
+    """
+    names = set()
+    complete = True
+
+    for engine in engines.all():
+        if not isinstance(engine, DjangoTemplates):
+            complete = False
+            continue
+
+        for template_loader in engine.engine.template_loaders:
+            complete = _index_loader(template_loader, prefix, names) and complete
+
+    return names, complete
+
+
+def template_exists(template_name, index):
+    names, complete = index
+    if template_name in names:
+        return True
+    if complete:
+        return False
+
+    try:
+        loader.get_template(template_name)
+    except TemplateDoesNotExist:
+        return False
+
+    return True
+
+
+def _compile(template_name):
+    try:
+        loader.get_template(template_name)
+    except TemplateSyntaxError as e:
+        return str(e)
+
+    return None
+
+
+def compile_templates(template_names, workers=None):
+    """
+    :return: template name to syntax error, for the templates that fail to compile
+    """
+    template_names = sorted(template_names)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=render._init_worker) as executor:
+        errors = executor.map(_compile, template_names, chunksize=max(len(template_names) // 64, 1))
+
+        return {template_name: error for template_name, error in zip(template_names, errors) if error}
@@ -0,0 +1,238 @@
+"""
+Server-sent events for unread count changes and new messages so clients can hold an idle connection open instead of
+polling the unread count endpoint. Requires running under ASGI. Events are published when the transaction that caused
+them commits.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+from collections import defaultdict
+from functools import lru_cache, partial
+
+from asgiref.sync import sync_to_async
+from django.db import connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.module_loading import import_string
+
+from inbox import settings as inbox_settings
+from inbox.signals import unread_count, new_message
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def put(self, event, data):
+        # Publishing happens from sync code, usually on a different thread than the subscriber's event loop
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (event, data))
+        except RuntimeError:
+            pass
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LocalBroker:
+    """
+    Fans events out to subscribers in this process only, fine for a single ASGI process or local development.
+    """
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id) -> Subscription:
+        subscription = Subscription(str(user_id))
+
+        with self._lock:
+            self._subscriptions[subscription.user_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id, event, data):
+        self.fanout(str(user_id), event, data)
+
+    def fanout(self, user_id, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+
+        for subscription in subscriptions:
+            subscription.put(event, data)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Publishes with NOTIFY so every process LISTENing gets the event. A single listener thread per process fans out to
+    that process' subscribers.
+    """
+    channel = 'inbox_stream'
+    reconnect_delay = 1
+    max_reconnect_delay = 60
+
+    def __init__(self, using='default'):
+        super().__init__()
+        self.using = using
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def subscribe(self, user_id) -> Subscription:
+        with self._lock:
+            if not self._listener or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='inbox-stream-listener', daemon=True)
+                self._listener.start()
+
+        return super().subscribe(user_id)
+
+    def publish(self, user_id, event, data):
+        payload = json.dumps({'user_id': str(user_id), 'event': event, 'data': data})
+
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, payload])
+
+    def stop(self):
+        """
+        Stop the listener thread, it exits within its select timeout.
+        """
+        self._stopped.set()
+
+    def _listen(self):
+        delay = self.reconnect_delay
+
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                wrapper = connections[self.using]
+                connection = wrapper.get_new_connection(wrapper.get_connection_params())
+                connection.autocommit = True
+
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+
+                delay = self.reconnect_delay
+                self._receive(connection)
+            except Exception as e:
+                # Keep subscribers attached and reconnect, events published while disconnected are lost
+                logger.error(f'Inbox stream listener disconnected, reconnecting in {delay}s: {e}')
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+    def _receive(self, connection):
+        while not self._stopped.is_set():
+            if select.select([connection], [], [], 60) == ([], [], []):
+                continue
+
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                try:
+                    payload = json.loads(notify.payload)
+                except ValueError:
+                    continue
+
+                self.fanout(payload['user_id'], payload['event'], payload['data'])
+
+
+@lru_cache()
+def _load_broker(path):
+    return import_string(path)()
+
+
+def get_broker():
+    path = inbox_settings.get_config()['STREAM_BACKEND']
+    if not path:
+        return None
+
+    return _load_broker(path)
+
+
+def on_unread_count(sender, user, count, **kwargs):
+    broker = get_broker()
+    if broker:
+        # Published once the change is committed, or a client could refetch and not see it yet
+        transaction.on_commit(partial(broker.publish, user.pk, 'unread_count', count))
+
+
+def on_new_message(sender, user, message, **kwargs):
+    broker = get_broker()
+    if broker:
+        transaction.on_commit(partial(broker.publish, user.pk, 'message', {'id': message.pk, 'key': message.key}))
+
+
+def connect_signals():
+    unread_count.connect(on_unread_count, dispatch_uid='inbox_stream_unread_count')
+    new_message.connect(on_new_message, dispatch_uid='inbox_stream_new_message')
+
+
+def _format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def _get_user(request):
+    from rest_framework.request import Request
+    from rest_framework.settings import api_settings
+
+    # Authenticate the same way as the rest of the API
+    authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    user = Request(request, authenticators=authenticators).user
+
+    return user if user and user.is_authenticated else None
+
+
+async def _stream_events(broker, user_id):
+    from inbox.models import Message
+
+    # Subscribe before reading the current count so nothing is missed in between
+    subscription = broker.subscribe(user_id)
+    heartbeat_interval = inbox_settings.get_config()['STREAM_HEARTBEAT_INTERVAL']
+
+    try:
+        count = await sync_to_async(Message.objects.unread_count)(user_id)
+        yield _format_event('unread_count', count)
+
+        while True:
+            try:
+                event, data = await asyncio.wait_for(subscription.get(), heartbeat_interval)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+
+            yield _format_event(event, data)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def view_message_stream(request):
+    broker = get_broker()
+    if broker is None:
+        return HttpResponse(status=404)
+
+    user = await sync_to_async(_get_user)(request)
+    if user is None:
+        return HttpResponse(status=401)
+
+    response = StreamingHttpResponse(_stream_events(broker, user.pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+
+    return response
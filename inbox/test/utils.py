@@ -7,11 +7,8 @@ from inbox.models import MessageLog, Message
 from inbox.utils import process_new_messages, process_new_message_logs
 
 
-INBOX_SETTINGS = inbox_settings.get_config()
-
-
 def dump_template(filename, content):
-    full_filename = os.path.join(INBOX_SETTINGS['TESTING_MEDIUM_OUTPUT_PATH'], filename)
+    full_filename = os.path.join(inbox_settings.get_config()['TESTING_MEDIUM_OUTPUT_PATH'], filename)
 
     if not os.path.exists(os.path.dirname(full_filename)):
         try:
@@ -0,0 +1,131 @@
+"""
+Cluster wide sends per second per medium, so every worker together stays under provider quotas (FCM, SMTP relay) and
+sends are spaced evenly rather than bursting. Configured in BACKENDS, eg:
+
+    "BACKENDS": {
+        ...
+        "MAX_SENDS_PER_SECOND": {"app_push": 500, "email": 14},
+    }
+
+Under PostgreSQL each send reserves the next slot in MediumThrottle with a single upsert in its own durable
+transaction, so the reservation is visible to other workers straight away. The slot is waited for before the send's
+transaction is opened. Called with a transaction already open, eg under ATOMIC_REQUESTS in the cron views, and on other
+databases, sends are only paced within the process.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db import connections, transaction
+
+from inbox import settings as inbox_settings
+from inbox.constants import MessageMedium
+
+logger = logging.getLogger(__name__)
+
+
+def get_max_sends_per_second(medium: MessageMedium):
+    return inbox_settings.get_config()['BACKENDS'].get('MAX_SENDS_PER_SECOND', {}).get(medium.name.lower())
+
+
+class Governor:
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.wait_seconds = defaultdict(float)
+        self._next_send_at = {}
+        self._lock = threading.Lock()
+        self._warned_in_transaction = False
+
+    def reserve(self, medium: MessageMedium) -> float:
+        """
+        Reserve the medium's next send slot.
+
+        :return: seconds until the slot
+        """
+        rate = get_max_sends_per_second(medium)
+        if not rate:
+            return 0
+
+        interval = 1 / rate
+        connection = connections[self.using]
+        if connection.vendor != 'postgresql':
+            wait_seconds = self._reserve_local(medium, interval)
+        elif connection.in_atomic_block:
+            # The reservation would only be seen by other workers once the caller's transaction commits
+            if not self._warned_in_transaction:
+                self._warned_in_transaction = True
+                logger.warning('Send slots reserved inside a transaction are only paced within this process')
+            wait_seconds = self._reserve_local(medium, interval)
+        else:
+            wait_seconds = self._reserve_shared(medium, interval)
+
+        wait_seconds = max(wait_seconds, 0)
+        if wait_seconds:
+            self.wait_seconds[medium.name.lower()] += wait_seconds
+
+        return wait_seconds
+
+    def wait(self, medium: MessageMedium) -> float:
+        """
+        Block until the medium has a free send slot.
+
+        :return: seconds waited
+        """
+        wait_seconds = self.reserve(medium)
+        if wait_seconds:
+            time.sleep(wait_seconds)
+
+        return wait_seconds
+
+    async def async_wait(self, medium: MessageMedium) -> float:
+        wait_seconds = await sync_to_async(self.reserve)(medium)
+        if wait_seconds:
+            await asyncio.sleep(wait_seconds)
+
+        return wait_seconds
+
+    def _reserve_local(self, medium, interval):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(self._next_send_at.get(medium, now), now)
+            self._next_send_at[medium] = send_at + interval
+
+        return send_at - now
+
+    def reset(self):
+        """Forget all reservations and throttled time, eg between tests."""
+        from inbox.models import MediumThrottle
+
+        with self._lock:
+            self._next_send_at.clear()
+            self.wait_seconds.clear()
+
+        if connections[self.using].vendor == 'postgresql':
+            MediumThrottle.objects.using(self.using).all().delete()
+
+    def _reserve_shared(self, medium, interval):
+        from inbox.models import MediumThrottle
+
+        table = MediumThrottle._meta.db_table
+        # Durable so the reservation is committed straight away
+        with transaction.atomic(using=self.using, durable=True), connections[self.using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (medium, next_send_at) '
+                f"VALUES (%s, clock_timestamp() + %s * interval '1 second') "
+                f'ON CONFLICT (medium) DO UPDATE '
+                f'SET next_send_at = GREATEST({table}.next_send_at, clock_timestamp()) '
+                f"+ %s * interval '1 second' "
+                f'RETURNING EXTRACT(EPOCH FROM {table}.next_send_at - clock_timestamp())',
+                [medium.value, interval, interval]
+            )
+            seconds_until_next = cursor.fetchone()[0]
+
+        # The reserved slot is the one before the new next_send_at
+        return float(seconds_until_next) - interval
+
+
+governor = Governor()
@@ -1,47 +1,169 @@
-from django.db import transaction
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db import transaction, connections
+from django.db.models import QuerySet, Value, Q
+from django.db.models.functions import Mod
 from django.utils import timezone
-from django.utils.module_loading import import_string
 
-from inbox import settings as inbox_settings
+from inbox import settings as inbox_settings, metrics, ratelimit, render
+from inbox.hooks import get_hook
+from inbox.throttle import governor
 from inbox.constants import MessageLogStatus, MessageMedium, MessageLogStatusReason
-from inbox.models import MessageLog, Message, get_default_preference_ids, MessagePreferences
+from inbox.models import MessageLog, Message, get_default_preference_ids, MessagePreferences, get_message_group
+from inbox.signals import new_message
 
-hooks_module = inbox_settings.get_config()['HOOKS_MODULE']
+logger = logging.getLogger(__name__)
 
 
-def process_new_messages():
-    limit = int(inbox_settings.get_config()['PROCESS_NEW_MESSAGES_LIMIT'])
+class BatchSize:
+    """
+    Batch limit for one of the processors. Fixed at the configured limit unless PROCESS_BATCH_TARGET_DURATION is set,
+    then it grows while batches come back full and finish well under the target, and shrinks when they run over.
+    """
+    def __init__(self, name, config_key):
+        self.name = name
+        self.config_key = config_key
+        self.limit = None
+        self._config = None
+
+    def _get_config(self):
+        config = inbox_settings.get_config()
+        # Start over from the configured limit when the config is reloaded, the adapted one was for the old settings
+        if config is not self._config:
+            self._config = config
+            self.limit = None
+
+        return config
+
+    @property
+    def current(self):
+        config = self._get_config()
+        if not config['PROCESS_BATCH_TARGET_DURATION']:
+            return int(config[self.config_key])
+
+        if self.limit is None:
+            self.limit = int(config[self.config_key])
+
+        return self.limit
+
+    def record(self, limit, processed_count, duration, backlog_queryset):
+        config = self._get_config()
+        target_duration = config['PROCESS_BATCH_TARGET_DURATION']
+
+        if target_duration:
+            target_seconds = target_duration.total_seconds()
+            if processed_count >= limit and duration < target_seconds / 2:
+                self.limit = min(limit * 2, int(config['PROCESS_BATCH_MAX_LIMIT']))
+            elif duration > target_seconds:
+                self.limit = max(int(limit * target_seconds / duration), 1)
+
+        # The backlog count is an extra query, only run it when it's going to be logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f'{self.name} processed {processed_count} of {limit} in {duration:.3f}s, '
+                        f'backlog {backlog_queryset.count()}, next limit {self.current}')
+
+
+new_messages_batch_size = BatchSize('process_new_messages', 'PROCESS_NEW_MESSAGES_LIMIT')
+new_message_logs_batch_size = BatchSize('process_new_message_logs', 'PROCESS_NEW_MESSAGE_LOGS_LIMIT')
+
+
+def parse_shard(value: str):
+    """
+    Parse a shard from "index/count", eg "0/4" is the first of four shards.
+    """
+    if not value:
+        return None
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard "{value}", expected "index/count".')
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard "{value}", index must be between 0 and count - 1.')
+
+    return index, count
+
+
+def filter_shard(queryset, shard, user_field):
+    """
+    Limit the queryset to users where user_id % count == index, all of a User's rows stay on the same worker.
+
+    MessageLog has no user_id of its own, its shard is filtered through message__user_id, a join to Message that
+    inbox_messagelog_new_idx can't cover.
+
+    :param shard: (index, count) or None for all users
+    """
+    if not shard:
+        return queryset
+
+    index, count = shard
+
+    return queryset.annotate(user_shard=Mod(user_field, Value(count))).filter(user_shard=index)
+
+
+def select_for_update_skip_locked(queryset):
+    # Only lock the queued rows, related rows joined for the batch may be the nullable side of an outer join, which
+    # can't be locked
+    of = ('self',) if connections[queryset.db].features.has_select_for_update_of else ()
+
+    return queryset.select_for_update(skip_locked=True, of=of)
+
+
+def process_new_messages(shard=None):
+    """
+    :param shard: (index, count), only process Messages for Users in that shard
+    """
+    limit = new_messages_batch_size.current
+    started_at = time.monotonic()
+
+    pending_messages = filter_shard(Message.objects.filter(send_at__lte=timezone.now(), is_logged=False), shard,
+                                    'user_id')
+    select_related, prefetch_related = render.get_user_relations('user__')
+    messages = select_for_update_skip_locked(pending_messages
+                                             .select_related('user', *select_related)
+                                             .prefetch_related(*prefetch_related)) \
+        .order_by('send_at')[:limit]
 
-    messages = Message.objects \
-                   .select_related('user') \
-                   .select_for_update(skip_locked=True) \
-                   .filter(send_at__lte=timezone.now(), is_logged=False) \
-                   .order_by('send_at')[:limit]
+    with metrics.measure('process_new_messages'):
+        processed_count = process_messages(messages)
 
-    process_messages(messages)
+    new_messages_batch_size.record(limit, processed_count, time.monotonic() - started_at, pending_messages)
+
+    return processed_count
 
 
 def process_messages(messages):
+    """
+    :return: number of messages processed
+    """
+    processed_count = 0
 
     with transaction.atomic():
+        with metrics.phase('claim'):
+            messages = list(messages)
+
         for message in messages:
+            processed_count += 1
 
             post_message_get = None
-            if hooks_module and not message.is_forced:
-                try:
-                    post_message_get = import_string(f'{hooks_module}.{message.key}.post_message_get')
-                except (ImportError, ModuleNotFoundError) as e:
-                    pass
+            if not message.is_forced:
+                post_message_get = get_hook(message.key, 'post_message_get')
 
             if post_message_get:
-                message = post_message_get(message)
+                with metrics.phase('hooks'):
+                    message = post_message_get(message)
 
             if not message:
                 continue
 
             # Determine what mediums, based on the config, that it can be sent to. We'll filter out by user's
             # preferences when processing the logs to actually send
-            mediums = [k for k, v in message._get_group_from_key()['preference_defaults'].items() if v is not None]
+            mediums = list(inbox_settings.get_config().group_mediums[message._get_group_from_key()['id']])
 
             skipped_mediums = []
             for medium in mediums:
@@ -54,80 +176,360 @@ def process_messages(messages):
                 message_log = MessageLog(message=message, medium=medium_enum, send_at=message.send_at)
 
                 pre_message_log_save = None
-                if hooks_module and not message.is_forced:
-                    try:
-                        pre_message_log_save = import_string(f'{hooks_module}.{message.key}.pre_message_log_save')
-                    except (ImportError, ModuleNotFoundError) as e:
-                        pass
+                if not message.is_forced:
+                    pre_message_log_save = get_hook(message.key, 'pre_message_log_save')
 
                 if pre_message_log_save:
-                    message_log = pre_message_log_save(message, medium_enum, message_log)
+                    with metrics.phase('hooks'):
+                        message_log = pre_message_log_save(message, medium_enum, message_log)
 
                 if message_log:
-                    message_log.save()
+                    with metrics.phase('persist'):
+                        message_log.save()
+                    metrics.increment(f'{medium}.logged')
 
                 post_message_log_save = None
-                if hooks_module and not message.is_forced:
-                    try:
-                        post_message_log_save = import_string(f'{hooks_module}.{message.key}.post_message_log_save')
-                    except (ImportError, ModuleNotFoundError):
-                        pass
+                if not message.is_forced:
+                    post_message_log_save = get_hook(message.key, 'post_message_log_save')
 
                 # Even if message_log is None we call the post_message_log_save for maximum flexibility
                 if post_message_log_save:
-                    post_message_log_save(message, medium_enum, message_log)
+                    with metrics.phase('hooks'):
+                        post_message_log_save(message, medium_enum, message_log)
 
             if message.logs.count() == 0 and skipped_mediums != mediums:
                 message.is_hidden = True
 
             post_message_to_logs = None
-            if hooks_module and not message.is_forced:
-                try:
-                    post_message_to_logs = import_string(f'{hooks_module}.{message.key}.post_message_to_logs')
-                except (ImportError, ModuleNotFoundError) as e:
-                    pass
+            if not message.is_forced:
+                post_message_to_logs = get_hook(message.key, 'post_message_to_logs')
 
             # Perform this hook at the last moment to allow any odd cases, eg message key skips all mediums always
             # but you still may want to hide the Message in the Inbox based on custom logic
             if post_message_to_logs:
-                message = post_message_to_logs(message)
+                with metrics.phase('hooks'):
+                    message = post_message_to_logs(message)
 
             message.is_logged = True
-            message.save()
+            with metrics.phase('persist'):
+                message.save()
 
+            if message.is_hidden:
+                metrics.increment('hidden')
 
-def process_new_message_logs():
-    limit = int(inbox_settings.get_config()['PROCESS_NEW_MESSAGE_LOGS_LIMIT'])
+            if not message.is_hidden and message.send_at <= timezone.now():
+                new_message.send(sender=Message, user=message.user, message=message)
 
-    message_logs = MessageLog.objects \
-                       .select_related('message', 'message__user') \
-                       .select_for_update(skip_locked=True) \
-                       .filter(send_at__lte=timezone.now(), status=MessageLogStatus.NEW) \
-                       .order_by('send_at')[:limit]
-    process_message_logs(message_logs)
+    return processed_count
 
 
-def process_message_logs(message_logs):
-    exceptions = []
+def get_pending_message_logs(now=None):
+    """
+    Due NEW logs, plus QUEUED logs whose lease has run out because the worker sending them stopped part way.
+    """
+    now = now or timezone.now()
+
+    return MessageLog.objects.filter(Q(status=MessageLogStatus.NEW, send_at__lte=now) |
+                                     Q(status=MessageLogStatus.QUEUED, claimed_until__lte=now))
+
+
+def claim_message_logs(queryset, limit=None):
+    """
+    Move up to limit logs to QUEUED under a lease and commit straight away, so sending happens outside of the
+    claiming transaction and each result is saved as soon as it's known. Logs are claimed in send_at order, unless the
+    queryset is already sliced.
+    """
+    config = inbox_settings.get_config()
+    claimed_until = timezone.now() + config['MESSAGE_LOG_LEASE']
+
+    # Relations read by can_send, backends and templates, loaded for the batch rather than per log
+    select_related, prefetch_related = render.get_user_relations('message__user__')
+    select_related += config['PROCESS_LOGS_SELECT_RELATED']
+    prefetch_related += config['PROCESS_LOGS_PREFETCH_RELATED']
+
+    queryset = select_for_update_skip_locked(queryset
+                                             .select_related('message', 'message__user', *select_related)
+                                             .prefetch_related(*prefetch_related))
+    if not queryset.query.is_sliced:
+        queryset = queryset.order_by('send_at')[:limit]
 
     with transaction.atomic():
-        for message_log in message_logs:
-            try:
-                can_send = message_log.can_send
-                if message_log.message.is_forced or can_send:
+        message_logs = list(queryset)
+
+        MessageLog.objects.filter(pk__in=[message_log.pk for message_log in message_logs]) \
+            .update(status=MessageLogStatus.QUEUED, claimed_until=claimed_until)
+
+    return message_logs
+
+
+def renew_lease(message_log_ids):
+    """
+    Extend the lease on claimed logs that haven't been sent yet, so a batch slowed down by pacing or a slow provider
+    isn't picked up by another worker part way through.
+
+    :return: when the lease should next be renewed, half way through the new one
+    """
+    lease = inbox_settings.get_config()['MESSAGE_LOG_LEASE']
+    now = timezone.now()
+
+    MessageLog.objects.filter(pk__in=message_log_ids, status=MessageLogStatus.QUEUED).update(claimed_until=now + lease)
+
+    return now + lease / 2
+
+
+def process_new_message_logs(shard=None):
+    """
+    :param shard: (index, count), only process MessageLogs for Users in that shard
+    """
+    limit = new_message_logs_batch_size.current
+    started_at = time.monotonic()
+
+    pending_message_logs = filter_shard(get_pending_message_logs(), shard, 'message__user_id')
+
+    with metrics.measure('process_new_message_logs'):
+        with metrics.phase('claim'):
+            message_logs = claim_message_logs(pending_message_logs, limit)
+
+        processed_count = process_message_logs(message_logs)
+
+    new_message_logs_batch_size.record(limit, processed_count, time.monotonic() - started_at, pending_message_logs)
+
+    return processed_count
+
+
+def drain(processor, batch_size: BatchSize, deadline=None, shard=None):
+    """
+    Keep running the processor until a batch comes back short (queue is empty) or the deadline passes, lets a single
+    cron hit clear a backlog.
+
+    :param processor: process_new_messages or process_new_message_logs
+    :param batch_size: the matching BatchSize
+    :param deadline: timedelta, defaults to PROCESS_DRAIN_DEADLINE
+    :param shard: (index, count) passed through to the processor
+    :return: total number processed
+    """
+    deadline = deadline or inbox_settings.get_config()['PROCESS_DRAIN_DEADLINE']
+    ends_at = time.monotonic() + deadline.total_seconds() if deadline else None
+
+    total_count = 0
+    while True:
+        limit = batch_size.current
+        processed_count = processor(shard=shard)
+        total_count += processed_count
+
+        if processed_count < limit or ends_at is None or time.monotonic() >= ends_at:
+            return total_count
+
+
+def drain_new_messages(deadline=None, shard=None):
+    return drain(process_new_messages, new_messages_batch_size, deadline, shard)
+
+
+def drain_new_message_logs(deadline=None, shard=None):
+    return drain(process_new_message_logs, new_message_logs_batch_size, deadline, shard)
+
+
+def _prepare_message_log(message_log):
+    """
+    :return: (can_send, should_send)
+    """
+    # The row stays QUEUED until the outcome is saved, if that never happens the lease runs out and it's resent
+    # with the same idempotency key
+    message_log.status = MessageLogStatus.NEW
+
+    with metrics.phase('can_send'):
+        can_send = message_log.can_send
+
+    if can_send and not message_log.message.is_forced:
+        retry_at = ratelimit.acquire(message_log.message.user_id, message_log.medium.name.lower(),
+                                     get_message_group(message_log.message.group_id))
+        if retry_at:
+            # Left as NEW and picked up again once the User's next window starts
+            message_log.send_at = retry_at
+            return can_send, False
+
+    return can_send, message_log.message.is_forced or can_send
+
+
+def _record_send(message_log, can_send, status_before_send):
+    """
+    :param status_before_send: the log's status just before send(), can_send may already have failed a forced log
+    :return: True if the send failed
+    """
+    # Backends record a failed send on the log rather than raising, only retry when the send itself failed
+    if message_log.status == MessageLogStatus.FAILED and status_before_send != MessageLogStatus.FAILED:
+        message_log.retry_or_fail(getattr(message_log, 'failure_reason', None))
+        return True
+
+    if can_send:
+        message_log.status = MessageLogStatus.SENT
+
+    return False
+
+
+def _finish_message_log(message_log):
+    message_log.claimed_until = None
+    with metrics.phase('persist'):
+        message_log.save()
+    metrics.increment(f'{message_log.medium.name.lower()}.{message_log.status.name.lower()}')
+
+
+def _prepare_message_logs(message_logs):
+    """
+    Decide which logs go out, the rest are finished and saved here so they aren't rendered for nothing.
+
+    :return: ([(message_log, can_send)] to send, number that failed)
+    """
+    to_send = []
+    failed_count = 0
+
+    for message_log in message_logs:
+        try:
+            # Transactions per log so a database error in one doesn't affect the rest of the batch
+            with transaction.atomic():
+                can_send, should_send = _prepare_message_log(message_log)
+        except Exception as e:
+            logger.exception(f'MessageLog {message_log.pk} failed to send: {e}')
+            message_log.retry_or_fail(str(e))
+            failed_count += 1
+            should_send = False
+
+        if should_send:
+            to_send.append((message_log, can_send))
+        else:
+            _finish_message_log(message_log)
+
+    return to_send, failed_count
+
+
+def _log_batch(throttled_seconds, failed_count, processed_count):
+    render.log_query_report()
+
+    for medium, seconds in throttled_seconds.items():
+        if seconds:
+            logger.info(f'process_message_logs throttled {medium} for {seconds:.3f}s')
+
+    if failed_count:
+        logger.warning(f'process_message_logs {failed_count} of {processed_count} failed')
+
+
+def process_message_logs(message_logs):
+    """
+    :return: number of message logs processed
+    """
+    throttled_seconds = defaultdict(float)
+    renew_at = timezone.now() + inbox_settings.get_config()['MESSAGE_LOG_LEASE'] / 2
+
+    if isinstance(message_logs, QuerySet):
+        # Claimed like process_new_message_logs does so other workers skip them while they're sent, a caller's
+        # select_for_update locks alone would only last as long as loading them
+        message_logs = claim_message_logs(message_logs)
+
+    to_send, failed_count = _prepare_message_logs(message_logs)
+
+    with metrics.phase('render'):
+        render.prerender_message_logs([message_log for message_log, can_send in to_send])
+
+    for k, (message_log, can_send) in enumerate(to_send):
+        if timezone.now() >= renew_at:
+            renew_at = renew_lease([unsent.pk for unsent, unsent_can_send in to_send[k:]])
+
+        try:
+            # Waited for with no transaction open, the slot is reserved in one of its own
+            with metrics.phase('throttle'):
+                throttled_seconds[message_log.medium.name.lower()] += governor.wait(message_log.medium)
+
+            with transaction.atomic():
+                status_before_send = message_log.status
+                with metrics.phase('send'):
                     message_log.send()
+
+                failed_count += _record_send(message_log, can_send, status_before_send)
+        except Exception as e:
+            logger.exception(f'MessageLog {message_log.pk} failed to send: {e}')
+            message_log.retry_or_fail(str(e))
+            failed_count += 1
+        finally:
+            _finish_message_log(message_log)
+
+    _log_batch(throttled_seconds, failed_count, len(message_logs))
+
+    return len(message_logs)
+
+
+async def aprocess_new_message_logs(shard=None, concurrency=None):
+    """
+    Async counterpart of process_new_message_logs, sends the claimed batch concurrently so a single worker can keep
+    many provider requests in flight. Database access goes through sync_to_async.
+
+    :param shard: (index, count), only process MessageLogs for Users in that shard
+    :param concurrency: most sends in flight at once, defaults to PROCESS_ASYNC_CONCURRENCY
+    """
+    limit = new_message_logs_batch_size.current
+    started_at = time.monotonic()
+
+    pending_message_logs = filter_shard(get_pending_message_logs(), shard, 'message__user_id')
+
+    with metrics.measure('aprocess_new_message_logs'):
+        with metrics.phase('claim'):
+            message_logs = await sync_to_async(claim_message_logs)(pending_message_logs, limit)
+
+        processed_count = await aprocess_message_logs(message_logs, concurrency)
+
+    await sync_to_async(new_message_logs_batch_size.record)(limit, processed_count, time.monotonic() - started_at,
+                                                            pending_message_logs)
+
+    return processed_count
+
+
+async def aprocess_message_logs(message_logs, concurrency=None):
+    """
+    :return: number of message logs processed
+    """
+    config = inbox_settings.get_config()
+    semaphore = asyncio.Semaphore(concurrency or config['PROCESS_ASYNC_CONCURRENCY'])
+    throttled_seconds = defaultdict(float)
+    unsent_ids = {message_log.pk for message_log in message_logs}
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(config['MESSAGE_LOG_LEASE'].total_seconds() / 2)
+            await sync_to_async(renew_lease)(list(unsent_ids))
+
+    async def send(message_log, can_send):
+        async with semaphore:
+            try:
+                with metrics.phase('throttle'):
+                    throttled_seconds[message_log.medium.name.lower()] += \
+                        await governor.async_wait(message_log.medium)
+                status_before_send = message_log.status
+                with metrics.phase('send'):
+                    await message_log.async_send()
+
+                return _record_send(message_log, can_send, status_before_send)
             except Exception as e:
-                message_log.status = MessageLogStatus.FAILED.value
-                message_log.failure_reason = str(e)
-                exceptions.append(e)
-            else:
-                if can_send:
-                    message_log.status = MessageLogStatus.SENT
+                logger.exception(f'MessageLog {message_log.pk} failed to send: {e}')
+                message_log.retry_or_fail(str(e))
+                return True
             finally:
-                message_log.save()
+                await sync_to_async(_finish_message_log)(message_log)
+                unsent_ids.discard(message_log.pk)
+
+    lease_task = asyncio.ensure_future(keep_lease())
+    try:
+        to_send, failed_count = await sync_to_async(_prepare_message_logs)(message_logs)
+        unsent_ids.intersection_update(message_log.pk for message_log, can_send in to_send)
+
+        with metrics.phase('render'):
+            await sync_to_async(render.prerender_message_logs)([message_log for message_log, can_send in to_send])
+
+        failed = await asyncio.gather(*(send(message_log, can_send) for message_log, can_send in to_send))
+    finally:
+        lease_task.cancel()
+
+    _log_batch(throttled_seconds, failed_count + sum(failed), len(message_logs))
 
-    if exceptions:
-        raise Exception(exceptions)
+    return len(message_logs)
 
 
 def save_message_preferences(message_preferences: MessagePreferences, data, preference_id: int = None,
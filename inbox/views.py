@@ -3,6 +3,8 @@ import base64
 from django.contrib.auth import get_user_model
 from django.core.signing import Signer
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError, NotFound, PermissionDenied
@@ -12,6 +14,8 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from rest_framework_extensions.mixins import NestedViewSetMixin
 
+from inbox import settings as inbox_settings
+from inbox.cache import get_cache, get_etag, get_cached_response_data, set_cached_response_data, make_etag
 from inbox.models import Message, MessagePreferences
 from inbox.permissions import IsOwner
 from inbox.serializers import MessageSerializer, MessageListSerializer, MessageUpdateSerializer
@@ -20,6 +24,38 @@ from inbox.utils import save_message_preferences
 User = get_user_model()
 
 
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(request, etag):
+    if not etag:
+        return False
+
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if if_none_match == ['*']:
+        return True
+
+    # If-None-Match uses the weak comparison, W/ is ignored on either side
+    return _strip_weak(etag) in {_strip_weak(tag) for tag in if_none_match}
+
+
+def get_message_preferences_etag(user_id, path):
+    """
+    Cheap version of a User's MessagePreferences, doesn't load or reconcile the stored groups. Includes the message
+    groups config since that changes what's returned as well.
+    """
+    rows = MessagePreferences.objects.filter(pk=user_id).values_list('updated_at', flat=True)[:1]
+    if not rows:
+        return None
+
+    # Rows from before updated_at was added have none until they're next saved
+    updated_at = rows[0]
+    version = updated_at.isoformat() if updated_at else 'none'
+
+    return make_etag(user_id, version, inbox_settings.get_config().message_groups_digest, path)
+
+
 class NestedMessagePreferencesMixin:
 
     @action(methods=['GET', 'PUT'], detail=True,
@@ -38,7 +74,15 @@ class NestedMessagePreferencesMixin:
         :param kwargs:
         :return:
         """
-        message_preferences = self.get_object().message_preferences
+        user = self.get_object()
+
+        etag = None
+        if self.request.method == 'GET' and not preference_id:
+            etag = get_message_preferences_etag(user.pk, request.path)
+            if is_not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        message_preferences = user.message_preferences
 
         if self.request.method == 'PUT':
             try:
@@ -54,7 +98,8 @@ class NestedMessagePreferencesMixin:
         if preference_id and medium_id:
             return Response(self.request.data, status=status.HTTP_200_OK)
         else:
-            return Response({'results': message_preferences.groups}, status=status.HTTP_200_OK)
+            headers = {'ETag': etag} if etag else None
+            return Response({'results': message_preferences.groups}, status=status.HTTP_200_OK, headers=headers)
 
 
 class NestedMessagesViewSet(NestedViewSetMixin, ListModelMixin, GenericViewSet):
@@ -69,7 +114,7 @@ class NestedMessagesViewSet(NestedViewSetMixin, ListModelMixin, GenericViewSet):
         now = timezone.now()
         # INFO ordering of the query is important here, aligns with the combined index
         qs = super().get_queryset().filter(send_at__lte=now, is_hidden=False, is_logged=True, deleted_at__isnull=True)
-        return qs
+        return qs.with_read_through_at()
 
     # TODO Move our common lib to a pip repo and use Action serializer
     def get_serializer_class(self):
@@ -81,16 +126,74 @@ class NestedMessagesViewSet(NestedViewSetMixin, ListModelMixin, GenericViewSet):
 
         return super().get_serializer_class()
 
+    def list(self, request, *args, **kwargs):
+        """
+        When MESSAGES_LIST_CACHE is set, responses are cached by the User's inbox version so unchanged inboxes are
+        returned without querying messages, and clients sending back the ETag get a 304.
+        """
+        if not get_cache():
+            return super().list(request, *args, **kwargs)
+
+        etag = get_etag(kwargs['parent_lookup_user'], request.get_full_path())
+        if is_not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        data = get_cached_response_data(etag)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            set_cached_response_data(etag, data)
+
+        return Response(data, headers={'ETag': etag})
+
     @action(detail=False, methods=['post'])
     def read(self, request, version, parent_lookup_user):
-        Message.objects.mark_all_read(user_id=parent_lookup_user)
+        """
+        Optionally accepts `up_to` as either a Message id or an ISO 8601 datetime, only Messages sent at or before
+        it are marked read.
+        """
+        up_to = request.data.get('up_to') if hasattr(request.data, 'get') else None
+        if up_to is not None:
+            if str(up_to).isdigit():
+                up_to = int(up_to)
+            else:
+                try:
+                    up_to = parse_datetime(str(up_to))
+                except ValueError:
+                    up_to = None
+
+                if up_to is None:
+                    raise ValidationError({'up_to': ['Must be a message id or an ISO 8601 datetime.']})
+
+                if timezone.is_naive(up_to):
+                    up_to = timezone.make_aware(up_to)
+
+        user = request.user if str(request.user.pk) == str(parent_lookup_user) else parent_lookup_user
+        Message.objects.mark_all_read(user, up_to=up_to)
         return Response(status=200)
 
     @action(detail=False, methods=['get'], url_path='unread[-_]count',
             permission_classes=(IsAuthenticated, IsOwner(actions='unread_count')))
     def unread_count(self, request, version, parent_lookup_user):
-        unread_count = Message.objects.unread_count(parent_lookup_user)
-        return Response(status=200, data=unread_count)
+        """
+        With MESSAGES_LIST_CACHE set the count is cached by the User's inbox version, otherwise the ETag is built from
+        the count itself which still saves sending the body.
+        """
+        if get_cache():
+            etag = get_etag(parent_lookup_user, request.path)
+            if is_not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+            unread_count = get_cached_response_data(etag)
+            if unread_count is None:
+                unread_count = Message.objects.unread_count(parent_lookup_user)
+                set_cached_response_data(etag, unread_count)
+        else:
+            unread_count = Message.objects.unread_count(parent_lookup_user)
+            etag = make_etag(parent_lookup_user, unread_count)
+            if is_not_modified(request, etag):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        return Response(status=200, data=unread_count, headers={'ETag': etag})
 
 
 class MessageViewSet(RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin, GenericViewSet):
@@ -105,7 +208,7 @@ class MessageViewSet(RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin, Ge
         now = timezone.now()
         # INFO ordering of the query is important here, aligns with the combined index
         qs = super().get_queryset().filter(send_at__lte=now, is_hidden=False, is_logged=True, deleted_at__isnull=True)
-        return qs
+        return qs.with_read_through_at()
 
     # TODO Move our common lib to a pip repo and use Action serializer
     def get_serializer_class(self):
@@ -144,12 +247,17 @@ class MessagePreferencesViewSet(RetrieveModelMixin, UpdateModelMixin, GenericVie
         if request.user.is_authenticated and user_id != str(request.user.pk):
             raise PermissionDenied
 
+        etag = get_message_preferences_etag(user_id, request.path)
+        if is_not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
         try:
             user = User.objects.get(pk=user_id)
         except User.DoesNotExist:
             return NotFound()
 
-        return Response({'results': user.message_preferences.groups}, status=status.HTTP_200_OK)
+        headers = {'ETag': etag} if etag else None
+        return Response({'results': user.message_preferences.groups}, status=status.HTTP_200_OK, headers=headers)
 
     def update(self, request, pk, *args, **kwargs):
         signer = Signer()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+
+import django
+
+
+def runbenchmarks():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    parser = argparse.ArgumentParser(description='Benchmark the inbox hot paths against a seeded test database.')
+    parser.add_argument('--users', type=int, default=50, help='Users to seed')
+    parser.add_argument('--messages-per-user', type=int, default=20,
+                        help='Messages seeded per User, and created per User by the message cases')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case, the median is reported')
+    parser.add_argument('--only', nargs='+', metavar='CASE', help='Only run these cases')
+    parser.add_argument('--output', metavar='FILE', help='Write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--import-time', action='store_true',
+                        help='Instead measure the start up of a fresh process setting up Django and importing inbox, '
+                             'over --repeat runs')
+    args = parser.parse_args()
+
+    django.setup()
+
+    from benchmarks.runner import run, run_import_time
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+    if args.import_time:
+        run_import_time(args.repeat, output=args.output, baseline=baseline)
+        return
+
+    run(args.users, args.messages_per_user, repeat=args.repeat, only=args.only, output=args.output,
+        baseline=baseline)
+
+
+if __name__ == '__main__':
+    runbenchmarks()
@@ -1,11 +1,14 @@
 import logging
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import mail
 from django.utils import timezone
 from faker import Faker
 
+from inbox import settings as inbox_settings
 from inbox.core import app_push
 from inbox.models import Message, MessageLog
+from inbox.utils import BatchSize
 from inbox.test.utils import InboxTestCaseMixin
 from tests.test import TransactionTestCase
 
@@ -46,3 +49,83 @@ class CronTestCase(InboxTestCaseMixin, TransactionTestCase):
         self.assertEqual(len(mail.outbox), 1)
 
         self.assertEqual(message.subject, "Default Subject Line's Text")
+
+    def test_cron_drains_backlog_until_deadline(self):
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG["PROCESS_NEW_MESSAGES_LIMIT"] = 2
+        INBOX_CONFIG["PROCESS_NEW_MESSAGE_LOGS_LIMIT"] = 2
+        INBOX_CONFIG["PROCESS_DRAIN_DEADLINE"] = timezone.timedelta(seconds=30)
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            for i in range(5):
+                Message.objects.create(user=self.user, key="default", fail_silently=False)
+
+            response = self.get("/cron/process_new_messages")
+            self.assertHTTP200(response)
+            self.assertEqual(Message.objects.filter(is_logged=False).count(), 0)
+
+            response = self.get("/cron/process_new_message_logs")
+            self.assertHTTP200(response)
+            self.assertEqual(len(mail.outbox), 5)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_adaptive_batch_size(self):
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG["PROCESS_BATCH_TARGET_DURATION"] = timezone.timedelta(seconds=2)
+        INBOX_CONFIG["PROCESS_BATCH_MAX_LIMIT"] = 60
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            batch_size = BatchSize("test", "PROCESS_NEW_MESSAGES_LIMIT")
+            pending = Message.objects.all()
+            self.assertEqual(batch_size.current, 25)
+
+            # Full and fast, grows up to the max
+            batch_size.record(25, 25, 0.1, pending)
+            self.assertEqual(batch_size.current, 50)
+            batch_size.record(50, 50, 0.1, pending)
+            self.assertEqual(batch_size.current, 60)
+
+            # Not full, stays the same
+            batch_size.record(60, 10, 0.1, pending)
+            self.assertEqual(batch_size.current, 60)
+
+            # Slow, shrinks towards the target duration
+            batch_size.record(60, 60, 4, pending)
+            self.assertEqual(batch_size.current, 30)
+
+            # Changing the settings starts over from the configured limit
+            with self.settings(INBOX_CONFIG={**INBOX_CONFIG, "PROCESS_NEW_MESSAGES_LIMIT": 40}):
+                self.assertEqual(batch_size.current, 40)
+                batch_size.record(40, 40, 0.1, pending)
+                self.assertEqual(batch_size.current, 60)
+
+            self.assertEqual(batch_size.current, 25)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_cron_process_new_messages_for_shard(self):
+
+        other_user = User.objects.create(
+            username=fake.user_name(), email=fake.ascii_email(), email_verified_on=timezone.now().date()
+        )
+        Message.objects.create(user=self.user, key="default", fail_silently=False)
+        Message.objects.create(user=other_user, key="default", fail_silently=False)
+
+        response = self.get("/cron/process_new_messages?shard=2/2")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.get(f"/cron/process_new_messages?shard={self.user.pk % 2}/2")
+        self.assertHTTP200(response)
+
+        self.assertTrue(Message.objects.get(user=self.user).is_logged)
+        self.assertFalse(Message.objects.get(user=other_user).is_logged)
+
+        response = self.get(f"/cron/process_new_messages?shard={other_user.pk % 2}/2")
+        self.assertHTTP200(response)
+
+        self.assertTrue(Message.objects.get(user=other_user).is_logged)
@@ -17,8 +17,6 @@ from inbox.core import app_push
 from inbox.models import (
     Message,
     MessageLog,
-    get_message_groups,
-    get_message_group,
     MessagePreferences,
 )
 from inbox.test.utils import InboxTestCaseMixin
@@ -127,8 +125,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
     @responses.activate
     def test_update_user_that_generates_inbox_message(self):
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
 
         user_id = 1
         user = User.objects.get(pk=user_id)
@@ -332,8 +328,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
 
         # We use lru_cache on INBOX_CONFIG, clear it out
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
 
         # Then override the INBOX_CONFIG setting, we'll add a new message group and see it we get the expected return
         INBOX_CONFIG = settings.INBOX_CONFIG.copy()
@@ -364,8 +358,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
         # Then override the INBOX_CONFIG setting, we'll add a new message group to the front
         #  and see it we get the expected return
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
         MESSAGE_GROUPS.insert(
             0,
             {
@@ -409,8 +401,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
         #  we do this so that a preference that is brought back and a user had chosen to enable/disable it we'd still
         #  have their old preference.
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
         INBOX_CONFIG["MESSAGE_GROUPS"] = [INBOX_CONFIG["MESSAGE_GROUPS"][0]]
         with self.settings(INBOX_CONFIG=INBOX_CONFIG):
             response = self.client.get(f"/api/v1/users/{user.pk}/message_preferences")
@@ -432,8 +422,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
             self.assertNotEqual(group["id"], "test_2")
 
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
         with self.settings(INBOX_CONFIG=INBOX_CONFIG):
             # Now save the single message group we have, it should still keep the old ones and include the new one even
             #  though they won't be returned in the API
@@ -471,8 +459,6 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
             self.assertNotEqual(group["id"], "test_1")
 
         inbox_settings.get_config.cache_clear()
-        get_message_group.cache_clear()
-        get_message_groups.cache_clear()
 
     def test_message_preference_medium(self):
         user_id = 1
@@ -569,6 +555,61 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
         self.validate(response.data, message)
         self.assertFalse(response.data["is_read"])
 
+    def test_get_messages_cached_by_inbox_version(self):
+        user_id = 1
+        user = User.objects.get(pk=user_id)
+        self.client.force_login(user)
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG["MESSAGES_LIST_CACHE"] = "default"
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            Message.objects.create(user=user, key="default")
+            process_new_messages()
+            process_new_message_logs()
+
+            response = self.get(f"/api/v1/users/{user_id}/messages")
+            self.assertHTTP200(response)
+            self.assertEqual(len(response.data["results"]), 1)
+            etag = response["ETag"]
+
+            # Unchanged inbox is served from the cache
+            with self.assertNumQueries(2):
+                response = self.get(f"/api/v1/users/{user_id}/messages")
+            self.assertHTTP200(response)
+            self.assertEqual(len(response.data["results"]), 1)
+            self.assertEqual(response["ETag"], etag)
+
+            response = self.get(
+                f"/api/v1/users/{user_id}/messages", HTTP_IF_NONE_MATCH=etag
+            )
+            self.assertEqual(response.status_code, 304)
+
+            # Marking read bumps the version
+            response = self.post(f"/api/v1/users/{user_id}/messages/read")
+            self.assertHTTP200(response)
+
+            response = self.get(
+                f"/api/v1/users/{user_id}/messages", HTTP_IF_NONE_MATCH=etag
+            )
+            self.assertHTTP200(response)
+            self.assertNotEqual(response["ETag"], etag)
+            self.assertTrue(response.data["results"][0]["is_read"])
+
+            # New messages bump the version once they are logged
+            etag = response["ETag"]
+            Message.objects.create(user=user, key="default")
+            process_new_messages()
+
+            response = self.get(
+                f"/api/v1/users/{user_id}/messages", HTTP_IF_NONE_MATCH=etag
+            )
+            self.assertHTTP200(response)
+            self.assertEqual(len(response.data["results"]), 2)
+
+        inbox_settings.get_config.cache_clear()
+
     def test_delete_message(self):
         user_id = 1
         user = User.objects.get(pk=user_id)
@@ -661,6 +702,86 @@ class EndpointTests(InboxTestCaseMixin, TransactionTestCase):
         self.assertEqual(response.data, 1)
         self.validate(response.data, unread_count)
 
+    def test_fetching_unread_count_not_modified(self):
+        user_id = 1
+        user = User.objects.get(pk=user_id)
+        self.client.force_login(user)
+
+        response = self.get(f"/api/v1/users/{user_id}/messages/unread-count")
+        self.assertHTTP200(response)
+        etag = response["ETag"]
+
+        response = self.get(
+            f"/api/v1/users/{user_id}/messages/unread-count", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # Tags are compared whole, with the weak comparison, and * matches anything
+        for if_none_match, status_code in ((f'W/"other", {etag}', 304), (etag[2:], 304), ('*', 304),
+                                           (f'{etag}x', 200), (f'W/"x{etag[3:]}', 200)):
+            response = self.get(
+                f"/api/v1/users/{user_id}/messages/unread-count", HTTP_IF_NONE_MATCH=if_none_match
+            )
+            self.assertEqual(response.status_code, status_code, if_none_match)
+
+        response = self.patch(f"/api/v1/users/{user_id}", {"first_name": "Test"})
+        self.assertHTTP200(response)
+
+        response = self.get(
+            f"/api/v1/users/{user_id}/messages/unread-count", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertHTTP200(response)
+        self.assertEqual(response.data, 1)
+
+    def test_message_preferences_not_modified(self):
+        user_id = 1
+        user = User.objects.get(pk=user_id)
+        self.client.force_login(user)
+
+        # First save creates the MessagePreferences
+        response = self._get_message_preferences(user_id)
+        self.assertHTTP200(response)
+
+        response = self._get_message_preferences(user_id)
+        self.assertHTTP200(response)
+        etag = response["ETag"]
+
+        response = self.client.get(
+            f"/api/v1/users/{user_id}/message_preferences", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.put(
+            f"/api/v1/users/{user_id}/message_preferences/default/email", False
+        )
+        self.assertHTTP200(response)
+
+        response = self.client.get(
+            f"/api/v1/users/{user_id}/message_preferences", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertHTTP200(response)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_message_preferences_not_modified_without_updated_at(self):
+        user_id = 1
+        user = User.objects.get(pk=user_id)
+        self.client.force_login(user)
+
+        response = self._get_message_preferences(user_id)
+        self.assertHTTP200(response)
+        MessagePreferences.objects.filter(pk=user_id).update(updated_at=None)
+
+        # Still cached by a stable version until the row is next saved
+        response = self._get_message_preferences(user_id)
+        self.assertHTTP200(response)
+        etag = response["ETag"]
+        self.assertIsNone(MessagePreferences.objects.get(pk=user_id).updated_at)
+
+        response = self.client.get(
+            f"/api/v1/users/{user_id}/message_preferences", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+
     def test_fetching_unread_count_with_underscore_path(self):
 
         user_id = 1
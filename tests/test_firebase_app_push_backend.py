@@ -101,8 +101,10 @@ class FirebaseAppPushBackendTestCase(InboxTestCaseMixin, TransactionTestCase):
         # notification key should be null now
         self.user.device_group.refresh_from_db()
         self.assertIsNone(self.user.device_group.notification_key)
-        message_log.refresh_from_db()
+        # Recorded on the log for the caller to save
         self.assertEqual(message_log.status, MessageLogStatus.FAILED)
+        message_log.refresh_from_db()
+        self.assertEqual(message_log.status, MessageLogStatus.NEW)
 
         responses.replace(
             responses.POST,
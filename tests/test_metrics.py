@@ -0,0 +1,116 @@
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+from faker import Faker
+
+from inbox import metrics
+from inbox import settings as inbox_settings
+from inbox.models import Message
+from inbox.test.utils import InboxTestCaseMixin
+from inbox.utils import aprocess_new_message_logs, process_new_messages, process_new_message_logs
+
+User = get_user_model()
+Faker.seed()
+fake = Faker()
+
+
+class CollectingSink:
+
+    emitted = []
+
+    def emit(self, batch_metrics):
+        self.emitted.append(batch_metrics)
+
+
+class MetricsTestCase(InboxTestCaseMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+        self.user.device_group.notification_key = 'fake-notification_key'
+        self.user.device_group.save()
+
+        CollectingSink.emitted = []
+        metrics._load_sink.cache_clear()
+        inbox_settings.get_config.cache_clear()
+
+    def tearDown(self):
+        super().tearDown()
+
+        metrics._load_sink.cache_clear()
+        inbox_settings.get_config.cache_clear()
+
+    def with_sinks(self, *sinks):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['METRICS_SINKS'] = list(sinks)
+        inbox_settings.get_config.cache_clear()
+
+        return self.settings(INBOX_CONFIG=INBOX_CONFIG)
+
+    def test_measure_nested_phases(self):
+        with metrics.measure('disabled') as batch_metrics:
+            self.assertIsNone(batch_metrics)
+
+        with self.with_sinks('tests.test_metrics.CollectingSink'):
+            with metrics.measure('test'):
+                with metrics.phase('outer'):
+                    with metrics.phase('inner'):
+                        User.objects.count()
+                metrics.increment('counted', 2)
+
+        self.assertEqual(len(CollectingSink.emitted), 1)
+        batch_metrics = CollectingSink.emitted[0]
+        self.assertEqual(batch_metrics.name, 'test')
+        self.assertEqual(batch_metrics.query_count, 1)
+        self.assertEqual(batch_metrics.counters, {'counted': 2})
+        self.assertEqual(set(batch_metrics.phases), {'outer', 'inner'})
+        # The outer phase excludes the time spent in the inner one
+        self.assertLessEqual(sum(batch_metrics.phases.values()), batch_metrics.duration)
+
+    def test_processors_report_to_sinks(self):
+        with self.with_sinks('inbox.metrics.LoggingSink', 'inbox.metrics.PrometheusTextSink'):
+            Message.objects.create(user=self.user, key='default')
+
+            with self.assertLogs('inbox.metrics', 'INFO') as logs:
+                process_new_messages()
+            self.assertIn('process_new_messages took', logs.output[0])
+            self.assertIn('counters app_push.logged=1 email.logged=1', logs.output[0])
+
+            process_new_message_logs()
+
+            response = self.client.get('/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'inbox_duration_seconds_count{name="process_new_messages"} 1', response.content)
+            self.assertIn(b'inbox_events_total{name="process_new_message_logs",event="email.sent"} 1',
+                          response.content)
+
+        inbox_settings.get_config.cache_clear()
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_process_new_message_logs_phases_and_outcomes(self):
+        with self.with_sinks('tests.test_metrics.CollectingSink'):
+            Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+            process_new_message_logs()
+
+        new_message_logs_metrics = CollectingSink.emitted[1]
+        self.assertEqual(new_message_logs_metrics.name, 'process_new_message_logs')
+        self.assertEqual(new_message_logs_metrics.counters, {'app_push.sent': 1, 'email.sent': 1})
+        self.assertEqual({'claim', 'render', 'can_send', 'throttle', 'send', 'persist'},
+                         set(new_message_logs_metrics.phases))
+        self.assertGreater(new_message_logs_metrics.query_count, 0)
+
+    def test_async_pipeline_counts_queries(self):
+        Message.objects.create(user=self.user, key='default')
+        process_new_messages()
+
+        with self.with_sinks('tests.test_metrics.CollectingSink'):
+            # The block opens on the event loop's thread, the queries run on the sync_to_async thread
+            self.assertEqual(async_to_sync(aprocess_new_message_logs)(), 2)
+
+        new_message_logs_metrics = CollectingSink.emitted[0]
+        self.assertEqual(new_message_logs_metrics.name, 'aprocess_new_message_logs')
+        self.assertGreater(new_message_logs_metrics.query_count, 0)
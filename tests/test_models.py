@@ -6,6 +6,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import mail
 from django.core.exceptions import ValidationError
+from django.core.mail.utils import DNS_NAME
 from django.test import TestCase, override_settings
 from django.utils import timezone
 from faker import Faker
@@ -15,9 +16,10 @@ from inbox import settings as inbox_settings
 from inbox import signals
 from inbox.constants import MessageLogStatus, MessageLogStatusReason
 from inbox.core import app_push
-from inbox.models import Message, MessageMedium, MessageLog
+from inbox.models import Message, MessageMedium, MessageLog, MessagePreferences, is_valid_message_preference_groups
 from inbox.test.utils import InboxTestCaseMixin
-from inbox.utils import process_new_messages, process_new_message_logs
+from inbox.utils import process_new_messages, process_new_message_logs, claim_message_logs, \
+    get_pending_message_logs
 
 User = get_user_model()
 Faker.seed()
@@ -113,6 +115,84 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
         # Assert the signal was called only once with the args
         handler.assert_called_once_with(signal=signals.unread_count, count=0, sender=Message, user=self.user)
 
+    def test_mark_all_read_up_to_watermark(self):
+
+        with freeze_time('2020-01-01'):
+            first = Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+            process_new_message_logs()
+
+        with freeze_time('2020-01-02'):
+            Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+            process_new_message_logs()
+
+            handler = MagicMock()
+            signals.unread_count.connect(handler, sender=Message)
+
+            # Message id watermark only marks the first one read
+            updated_count = Message.objects.mark_all_read(self.user, up_to=first.pk)
+            self.assertEqual(updated_count, 1)
+            self.assertEqual(Message.objects.unread_count(self.user.pk), 1)
+            handler.assert_called_once_with(signal=signals.unread_count, count=1, sender=Message, user=self.user)
+
+            # Nothing left before the watermark, no push or signal
+            app_push.outbox = []
+            handler.reset_mock()
+            updated_count = Message.objects.mark_all_read(self.user, up_to=timezone.now() - timezone.timedelta(hours=1))
+            self.assertEqual(updated_count, 0)
+            self.assertEqual(len(app_push.outbox), 0)
+            handler.assert_not_called()
+
+            # Passing the User instance doesn't fetch it again
+            with self.assertNumQueries(1):
+                updated_count = Message.objects.mark_all_read(self.user)
+            self.assertEqual(updated_count, 1)
+            self.assertEqual(Message.objects.unread_count(self.user.pk), 0)
+            handler.assert_called_once_with(signal=signals.unread_count, count=0, sender=Message, user=self.user)
+
+    def test_mark_all_read_with_read_watermark(self):
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['READ_WATERMARK'] = True
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            with freeze_time('2020-01-01'):
+                first = Message.objects.create(user=self.user, key='default')
+                Message.objects.create(user=self.user, key='default')
+                process_new_messages()
+                process_new_message_logs()
+
+                self.assertEqual(Message.objects.unread_count(self.user.pk), 2)
+
+                # Only whether any were marked read, the rows aren't counted
+                self.assertEqual(Message.objects.mark_all_read(self.user), 1)
+
+                # Rows are left untouched, the watermark makes them read
+                self.assertEqual(Message.objects.filter(user=self.user, read_at__isnull=True).count(), 2)
+                self.assertEqual(Message.objects.unread_count(self.user.pk), 0)
+                self.assertEqual(self.user.inbox_state.read_through_at, timezone.now())
+                self.assertTrue(all(m.is_read for m in Message.objects.filter(user=self.user).with_read_through_at()))
+
+            with freeze_time('2020-01-02'):
+                Message.objects.create(user=self.user, key='default')
+                process_new_messages()
+                process_new_message_logs()
+
+                self.assertEqual(Message.objects.unread_count(self.user.pk), 1)
+
+                # Marking a Message from before the watermark unread writes the watermark out to the rows
+                first.refresh_from_db()
+                first.is_read = False
+                first.save()
+
+                self.assertFalse(first.is_read)
+                self.assertEqual(Message.objects.unread_count(self.user.pk), 2)
+                self.assertEqual(Message.objects.filter(user=self.user, read_at__isnull=True).count(), 2)
+
+        inbox_settings.get_config.cache_clear()
+
     def test_save_message_with_key_not_in_a_group(self):
         # We use lru_cache on INBOX_CONFIG, clear it out
         inbox_settings.get_config.cache_clear()
@@ -127,6 +207,18 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
 
         inbox_settings.get_config.cache_clear()
 
+    def test_message_group_for_unknown_key_is_default(self):
+        message = Message(user=self.user, key='key_not_in_a_group', group_id='group_no_longer_configured')
+
+        self.assertEqual(message._get_group_from_key()['id'], 'default')
+        self.assertEqual(message.group['id'], 'default')
+        self.assertFalse(message.should_skip_medium('email'))
+
+        message.key = 'group_with_skip_push_2'
+        self.assertEqual(message._get_group_from_key()['id'], 'group_with_skip_push')
+        self.assertTrue(message.should_skip_medium('app_push'))
+        self.assertFalse(message.should_skip_medium('email'))
+
     def test_save_message_with_invalid_key(self):
 
         # We use lru_cache on INBOX_CONFIG, clear it out
@@ -181,6 +273,31 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
         self.assertEqual(existing_message_ids, set([test_message_id]))
         self.assertEqual(missing_message_ids, set(['123']))
 
+    def test_message_id_exists_for_user_in_chunks(self):
+        email = fake.ascii_email()
+        other_user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+
+        Message.objects.create(user=self.user, key='default', message_id='a')
+        Message.objects.create(user=other_user, key='default', message_id='b')
+
+        message_ids = ('a', 'b', 'c', 'a', 'd')
+
+        self.assertEqual(Message.objects.exists(iter(message_ids)), ({'a', 'b'}, {'c', 'd'}))
+        self.assertEqual(Message.objects.exists({'a', 'c'}), ({'a'}, {'c'}))
+
+        # A single id that isn't a str is still a single id
+        message_id = uuid.uuid4()
+        self.assertEqual(Message.objects.exists(message_id), (set(), {message_id}))
+        self.assertEqual(Message.objects.exists(1), (set(), {1}))
+
+        with self.assertNumQueries(2):
+            self.assertEqual(Message.objects.exists(message_ids, user=self.user, chunk_size=2), ({'a'}, {'b', 'c', 'd'}))
+
+        chunks = list(Message.objects.iter_exists(message_ids, user=other_user.pk, chunk_size=2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(set().union(*[existing for existing, missing in chunks]), {'b'})
+        self.assertEqual(set().union(*[missing for existing, missing in chunks]), {'a', 'c', 'd'})
+
     def test_create_message_process_message_logs(self):
 
         self.assertEqual(MessageLog.objects.count(), 0)
@@ -463,10 +580,44 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
         process_new_messages()
         process_new_message_logs()
 
-        self.assertEqual(mail.outbox[0].extra_headers, {'X-MC-Tags': 'default',
+        message_log = MessageLog.objects.get(medium=MessageMedium.EMAIL)
+        self.assertEqual(mail.outbox[0].extra_headers, {'Message-ID': f'<{message_log.idempotency_key}@{DNS_NAME}>',
+                                                        'X-MC-Tags': 'default',
                                                         'X-SMTPAPI': '{"category": "default"}',
                                                         'X-Mailgun-Tag': 'default'})
 
+    def test_expired_claim_is_resent_with_same_idempotency_key(self):
+
+        Message.objects.create(user=self.user, key='default')
+        process_new_messages()
+
+        # Worker claims the logs and then stops before sending
+        claim_message_logs(get_pending_message_logs(), 10)
+        self.assertEqual(MessageLog.objects.filter(status=MessageLogStatus.QUEUED).count(), 2)
+
+        process_new_message_logs()
+        self.assertEqual(len(mail.outbox), 0)
+
+        with freeze_time(timezone.now() + timezone.timedelta(minutes=6)):
+            process_new_message_logs()
+
+        self.assertEqual(MessageLog.objects.filter(status=MessageLogStatus.SENT).count(), 2)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(app_push.outbox), 2)
+
+        # Worker sent but stopped before saving the result
+        message_log = MessageLog.objects.get(medium=MessageMedium.APP_PUSH)
+        MessageLog.objects.filter(pk=message_log.pk).update(status=MessageLogStatus.QUEUED,
+                                                            claimed_until=timezone.now())
+
+        process_new_message_logs()
+
+        message_log.refresh_from_db()
+        self.assertEqual(message_log.status, MessageLogStatus.SENT)
+        self.assertIsNone(message_log.claimed_until)
+        # The backend recognised the resent push
+        self.assertEqual(len(app_push.outbox), 2)
+
     def test_hook_fails_catches_exception(self):
 
         self.assertEqual(MessageLog.objects.count(), 0)
@@ -483,14 +634,56 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
         self.assertEqual(len(message_logs), 1)
         self.assertEqual(message_logs[0].status, MessageLogStatus.NEW)
 
-        self.assertRaises(Exception, process_new_message_logs)
+        # The failure is kept to the log rather than raised for the batch
+        process_new_message_logs()
+
+        message_log = MessageLog.objects.get(message__user=self.user)
+        self.assertEqual(message_log.status, MessageLogStatus.NEW)
+        self.assertEqual(message_log.failed_attempts, 1)
+        self.assertIn('missing_prop', message_log.status_reason)
 
-        message_logs = MessageLog.objects.filter(message__user=self.user)
-        self.assertEqual(len(message_logs), 1)
-        self.assertEqual(message_logs[0].status, MessageLogStatus.FAILED)
+        # Retried after a 30s backoff, plus up to 25% jitter
+        self.assertGreaterEqual(message_log.send_at, timezone.now() + timezone.timedelta(seconds=29))
+        self.assertLessEqual(message_log.send_at, timezone.now() + timezone.timedelta(seconds=38))
 
-        # Running process_new_message_logs again shouldn't raise an error
+        # Not due yet
         process_new_message_logs()
+        message_log.refresh_from_db()
+        self.assertEqual(message_log.failed_attempts, 1)
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['MESSAGE_LOG_MAX_RETRIES'] = 1
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            with freeze_time(timezone.now() + timezone.timedelta(minutes=1)):
+                process_new_message_logs()
+
+            message_log.refresh_from_db()
+            self.assertEqual(message_log.status, MessageLogStatus.FAILED)
+            self.assertEqual(message_log.failed_attempts, 2)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_forced_email_to_unverified_user_is_not_retried(self):
+        email = fake.ascii_email()
+        user = User.objects.create(email=email, username=email)
+
+        Message.objects.create(user=user, key='account_updated', is_forced=True, fail_silently=False)
+
+        process_new_messages()
+        process_new_message_logs()
+
+        self.assertEqual(len(mail.outbox), 1)
+
+        message_log = MessageLog.objects.get(message__user=user, medium=MessageMedium.EMAIL)
+        self.assertEqual(message_log.status, MessageLogStatus.FAILED)
+        self.assertEqual(message_log.failed_attempts, 0)
+
+        with freeze_time(timezone.now() + timezone.timedelta(hours=2)):
+            process_new_message_logs()
+
+        self.assertEqual(len(mail.outbox), 1)
 
     def test_send_at_not_in_range_does_not_send(self):
 
@@ -551,3 +744,42 @@ class MessageTestCase(InboxTestCaseMixin, TestCase):
 
         # Reset as to not break other tests
         inbox_config['MAX_AGE_BEYOND_SEND_AT'] = original_value
+
+
+class MessagePreferencesSchemaTestCase(TestCase):
+
+    def test_fast_validator_matches_schema(self):
+        from jsonschema import validate, exceptions as jsonschema_exceptions
+
+        schema = MessagePreferences._meta.get_field('_groups')._schema_data
+        values = [
+            [{'id': 'default'}],
+            [{'id': 'default', 'app_push': True, 'email': False, 'sms': True, 'web_push': False}],
+            [],
+            None,
+            {'id': 'default'},
+            [{'email': True}],
+            [{'id': 1}],
+            [{'id': 'default', 'email': 1}],
+            [{'id': 'default', 'email': None}],
+            [{'id': 'default', 'label': 'Default'}],
+            [{'id': 'default'}, 'default'],
+        ]
+
+        for value in values:
+            try:
+                validate(value, schema)
+            except jsonschema_exceptions.ValidationError:
+                is_valid = False
+            else:
+                is_valid = True
+
+            self.assertEqual(is_valid_message_preference_groups(value), is_valid, value)
+
+    def test_invalid_value_raises_schema_error(self):
+        field = MessagePreferences._meta.get_field('_groups')
+
+        with self.assertRaises(ValidationError) as context:
+            field._validate_schema([{'id': 'default', 'email': 'yes'}])
+
+        self.assertEqual(context.exception.messages, ["'yes' is not of type 'boolean'"])
@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+from faker import Faker
+
+from inbox import render
+from inbox import settings as inbox_settings
+from inbox.models import Message
+from inbox.test.utils import InboxTestCaseMixin
+from inbox.utils import process_new_messages, claim_message_logs, get_pending_message_logs
+
+User = get_user_model()
+Faker.seed()
+fake = Faker()
+
+
+class RenderTestCase(InboxTestCaseMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+        self.user.device_group.notification_key = 'fake-notification_key'
+        self.user.device_group.save()
+
+        inbox_settings.get_config.cache_clear()
+
+    def tearDown(self):
+        super().tearDown()
+
+        render.query_report.clear()
+        inbox_settings.get_config.cache_clear()
+
+    def test_template_context_user_fields(self):
+        message = Message.objects.create(user=self.user, key='default')
+
+        self.assertEqual(message._get_context_for_template()['user'], self.user)
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['TEMPLATE_CONTEXT_USER_FIELDS'] = ['email', 'get_username']
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            self.assertEqual(message._get_context_for_template()['user'],
+                             {'email': self.user.email, 'get_username': self.user.username})
+
+    def test_claim_loads_template_context_user_relations(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['TEMPLATE_CONTEXT_USER_SELECT_RELATED'] = ['device_group']
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+
+            message_logs = claim_message_logs(get_pending_message_logs(), 10)
+
+            with self.assertNumQueries(0):
+                for message_log in message_logs:
+                    self.assertEqual(message_log.message.user.notification_key, 'fake-notification_key')
+
+    def test_query_report(self):
+        with render.track_render_queries('default'):
+            User.objects.count()
+
+        self.assertEqual(len(render.query_report), 0)
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['TEMPLATE_CONTEXT_DEBUG'] = True
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            for i in range(2):
+                with render.track_render_queries('default'):
+                    User.objects.count()
+
+            self.assertEqual(render.query_report['default'], {'renders': 2, 'queries': 2})
+
+            with self.assertLogs('inbox.render', 'WARNING') as logs:
+                render.log_query_report()
+
+            self.assertEqual(logs.output, ['WARNING:inbox.render:Rendering default issued 2 queries over 2 renders'])
+            self.assertEqual(len(render.query_report), 0)
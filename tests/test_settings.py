@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.utils import timezone
 from faker import Faker
 
 from inbox import settings as inbox_settings
+from inbox.hooks import get_hook
+from inbox.models import Message
 
 User = get_user_model()
 fake = Faker()
@@ -34,6 +37,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 }
             ],
             # Callable that returns the Firebase push notification key so that a user can be sent pushes, or None
@@ -47,18 +51,43 @@ class SettingsTestCase(TestCase):
                     "PROJECT_ID": 12345,
                     "ENV": "app_engine",  # 'app_engine' or None
                 },
+                "MAX_SENDS_PER_SECOND": {},
             },
             "TESTING_MEDIUM_OUTPUT_PATH": None,
             "DISABLE_NEW_DATA_SILENT_APP_PUSH": False,
             "MESSAGE_CREATE_FAIL_SILENTLY": True,
+            "MESSAGE_EXISTS_CHUNK_SIZE": 5000,
             "HOOKS_MODULE": None,
             "PROCESS_NEW_MESSAGES_LIMIT": 25,
             "PROCESS_NEW_MESSAGE_LOGS_LIMIT": 25,
+            "PROCESS_BATCH_TARGET_DURATION": None,
+            "PROCESS_BATCH_MAX_LIMIT": 500,
+            "PROCESS_DRAIN_DEADLINE": None,
+            "PROCESS_ASYNC_CONCURRENCY": 100,
+            "PROCESS_LOGS_SELECT_RELATED": ["message__user__message_preferences"],
+            "PROCESS_LOGS_PREFETCH_RELATED": [],
+            "PROCESS_RENDER_POOL_SIZE": None,
+            "TEMPLATE_CONTEXT_USER_FIELDS": None,
+            "TEMPLATE_CONTEXT_USER_SELECT_RELATED": [],
+            "TEMPLATE_CONTEXT_USER_PREFETCH_RELATED": [],
+            "TEMPLATE_CONTEXT_DEBUG": False,
+            "METRICS_SINKS": [],
+            "MESSAGE_LOG_MAX_RETRIES": 5,
+            "MESSAGE_LOG_RETRY_BACKOFF": timezone.timedelta(seconds=30),
+            "MESSAGE_LOG_RETRY_BACKOFF_MAX": timezone.timedelta(hours=1),
+            "MESSAGE_LOG_LEASE": timezone.timedelta(minutes=5),
             "PER_USER_MESSAGES_MAX_AGE": None,
             "PER_USER_MESSAGES_MAX_COUNT": None,
             "PER_USER_MESSAGES_MIN_AGE": None,
             "PER_USER_MESSAGES_MIN_COUNT": None,
             "MAX_AGE_BEYOND_SEND_AT": None,
+            "READ_WATERMARK": False,
+            "MESSAGES_LIST_CACHE": None,
+            "MESSAGES_LIST_CACHE_TIMEOUT": 300,
+            "STREAM_BACKEND": None,
+            "STREAM_HEARTBEAT_INTERVAL": 15,
+            "RATE_LIMITS": {},
+            "RATE_LIMIT_CACHE": "default",
         }
 
         with self.settings(INBOX_CONFIG={}):
@@ -91,6 +120,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": ["hook_fails_throws_exception"],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "inbox_only",
@@ -110,6 +140,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "account_updated",
@@ -129,6 +160,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "friend_requests",
@@ -148,6 +180,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "important_updates",
@@ -167,6 +200,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "push_only_group",
@@ -186,6 +220,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "group_with_all_mediums_off",
@@ -205,6 +240,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": [],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
                 {
                     "id": "group_with_skip_push",
@@ -231,6 +267,7 @@ class SettingsTestCase(TestCase):
                     "skip_email": ["group_with_skip_push_3"],
                     "skip_web_push": [],
                     "skip_sms": [],
+                    "rate_limits": {},
                 },
             ],
             "CHECK_IS_EMAIL_VERIFIED": True,
@@ -246,14 +283,38 @@ class SettingsTestCase(TestCase):
             "TESTING_MEDIUM_OUTPUT_PATH": None,
             "DISABLE_NEW_DATA_SILENT_APP_PUSH": False,
             "MESSAGE_CREATE_FAIL_SILENTLY": True,
+            "MESSAGE_EXISTS_CHUNK_SIZE": 5000,
             "HOOKS_MODULE": "tests.hooks",
             "PROCESS_NEW_MESSAGES_LIMIT": 25,
             "PROCESS_NEW_MESSAGE_LOGS_LIMIT": 25,
+            "PROCESS_BATCH_TARGET_DURATION": None,
+            "PROCESS_BATCH_MAX_LIMIT": 500,
+            "PROCESS_DRAIN_DEADLINE": None,
+            "PROCESS_ASYNC_CONCURRENCY": 100,
+            "PROCESS_LOGS_SELECT_RELATED": ["message__user__message_preferences"],
+            "PROCESS_LOGS_PREFETCH_RELATED": [],
+            "PROCESS_RENDER_POOL_SIZE": None,
+            "TEMPLATE_CONTEXT_USER_FIELDS": None,
+            "TEMPLATE_CONTEXT_USER_SELECT_RELATED": [],
+            "TEMPLATE_CONTEXT_USER_PREFETCH_RELATED": [],
+            "TEMPLATE_CONTEXT_DEBUG": False,
+            "METRICS_SINKS": [],
+            "MESSAGE_LOG_MAX_RETRIES": 5,
+            "MESSAGE_LOG_RETRY_BACKOFF": timezone.timedelta(seconds=30),
+            "MESSAGE_LOG_RETRY_BACKOFF_MAX": timezone.timedelta(hours=1),
+            "MESSAGE_LOG_LEASE": timezone.timedelta(minutes=5),
             "PER_USER_MESSAGES_MAX_AGE": None,
             "PER_USER_MESSAGES_MAX_COUNT": None,
             "PER_USER_MESSAGES_MIN_AGE": None,
             "PER_USER_MESSAGES_MIN_COUNT": None,
             "MAX_AGE_BEYOND_SEND_AT": timezone.timedelta(days=2),
+            "READ_WATERMARK": False,
+            "MESSAGES_LIST_CACHE": None,
+            "MESSAGES_LIST_CACHE_TIMEOUT": 300,
+            "STREAM_BACKEND": None,
+            "STREAM_HEARTBEAT_INTERVAL": 15,
+            "RATE_LIMITS": {},
+            "RATE_LIMIT_CACHE": "default",
         }
 
         inbox_settings.get_config.cache_clear()
@@ -261,3 +322,68 @@ class SettingsTestCase(TestCase):
 
         self.maxDiff = 8192
         self.assertEqual(settings, test_app_config)
+
+
+class ConfigTestCase(TestCase):
+
+    def test_config_is_read_only(self):
+        config = inbox_settings.get_config()
+
+        with self.assertRaises(TypeError):
+            config['HOOKS_MODULE'] = None
+
+        with self.assertRaises(TypeError):
+            config.groups_by_key['default'] = None
+
+        message_group = config['MESSAGE_GROUPS'][0]
+        with self.assertRaises(TypeError):
+            message_group['label'] = None
+        with self.assertRaises(TypeError):
+            message_group['preference_defaults']['sms'] = True
+        with self.assertRaises(AttributeError):
+            message_group['message_keys'].append('new_key')
+        with self.assertRaises(AttributeError):
+            config['MESSAGE_GROUPS'].append(message_group)
+        with self.assertRaises(TypeError):
+            config['BACKENDS']['APP_PUSH_CONFIG']['PROJECT_ID'] = None
+
+    def test_setting_is_not_modified(self):
+        inbox_settings.reload()
+
+        self.assertNotIn('skip_sms', settings.INBOX_CONFIG['MESSAGE_GROUPS'][0])
+        self.assertEqual(inbox_settings.get_config()['MESSAGE_GROUPS'][0]['skip_sms'], ())
+
+    def test_lookup_tables(self):
+        config = inbox_settings.get_config()
+
+        self.assertEqual(config.default_group['id'], 'default')
+        self.assertEqual(config.groups_by_id['friend_requests']['label'], 'Friend Requests')
+        self.assertEqual(config.groups_by_key['group_with_skip_push_2']['id'], 'group_with_skip_push')
+        self.assertEqual(config.skip_keys['app_push'], {'group_with_skip_push_2', 'group_with_skip_push_3'})
+        self.assertEqual(config.group_mediums['push_only_group'], ('app_push',))
+        self.assertEqual(config.enabled_mediums, {'app_push', 'email', 'sms', 'web_push'})
+        self.assertNotIn('inbox_only', [preference['id'] for preference in config.default_preferences])
+
+    def test_reloads_when_setting_changes(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['MESSAGE_GROUPS'] = [INBOX_CONFIG['MESSAGE_GROUPS'][1]]
+
+        message_groups_digest = inbox_settings.get_config().message_groups_digest
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            self.assertEqual(inbox_settings.get_config().default_group['id'], 'inbox_only')
+            self.assertNotEqual(inbox_settings.get_config().message_groups_digest, message_groups_digest)
+
+        self.assertEqual(inbox_settings.get_config().default_group['id'], 'default')
+        self.assertEqual(inbox_settings.get_config().message_groups_digest, message_groups_digest)
+
+    def test_config_is_read_when_used(self):
+        self.assertIsNotNone(get_hook('new_friend_request', 'pre_message_log_save'))
+        self.assertEqual(Message().group_id, 'default')
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['HOOKS_MODULE'] = None
+        INBOX_CONFIG['MESSAGE_GROUPS'] = [INBOX_CONFIG['MESSAGE_GROUPS'][1]]
+
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            self.assertIsNone(get_hook('new_friend_request', 'pre_message_log_save'))
+            self.assertEqual(Message().group_id, 'inbox_only')
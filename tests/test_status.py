@@ -0,0 +1,93 @@
+import json
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from faker import Faker
+
+from inbox.models import Message
+from inbox import status
+from inbox.status import get_queue_status, get_template_index, template_exists
+from inbox.test.utils import InboxTestCaseMixin
+from inbox.utils import process_new_messages, process_new_message_logs
+
+User = get_user_model()
+Faker.seed()
+fake = Faker()
+
+
+class StatusTestCase(InboxTestCaseMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+        self.user.device_group.notification_key = 'fake-notification_key'
+        self.user.device_group.save()
+
+    def test_queue_status(self):
+        send_at = timezone.now() - timedelta(minutes=10)
+        Message.objects.create(user=self.user, key='account_updated', send_at=send_at)
+        Message.objects.create(user=self.user, key='account_updated', send_at=timezone.now() + timedelta(days=1))
+
+        queue_status = get_queue_status()
+        self.assertEqual(queue_status['messages']['unlogged'], 2)
+        self.assertGreaterEqual(queue_status['messages']['lag_seconds'], 600)
+        self.assertEqual(queue_status['message_logs']['lag_seconds'], 0)
+
+        process_new_messages()
+
+        queue_status = get_queue_status()
+        self.assertEqual(queue_status['messages']['unlogged'], 1)
+        self.assertEqual(queue_status['messages']['lag_seconds'], 0)
+        self.assertEqual(queue_status['message_logs']['new']['app_push'], 1)
+        self.assertEqual(queue_status['message_logs']['new']['email'], 1)
+        self.assertGreaterEqual(queue_status['message_logs']['lag_seconds'], 600)
+
+        process_new_message_logs()
+
+        queue_status = get_queue_status()
+        self.assertEqual(queue_status['message_logs']['new']['app_push'], 0)
+        self.assertEqual(queue_status['message_logs']['lag_seconds'], 0)
+        for window in queue_status['throughput']:
+            self.assertEqual(window['sent']['app_push'], 1)
+            self.assertEqual(window['sent']['email'], 1)
+            self.assertEqual(window['failed']['email'], 0)
+
+    def test_inbox_status_json(self):
+        Message.objects.create(user=self.user, key='new_friend_request')
+
+        stdout = StringIO()
+        call_command('inbox_status', '--json', stdout=stdout)
+        report = json.loads(stdout.getvalue())
+
+        self.assertEqual(report['queue']['messages']['unlogged'], 1)
+        self.assertIn({'file': 'inbox/new_friend_request/body_email.html', 'key': 'new_friend_request',
+                       'medium': 'email', 'required': True, 'found': True}, report['templates'])
+
+    def test_template_index(self):
+        names, complete = get_template_index()
+
+        self.assertTrue(complete)
+        self.assertIn('inbox/new_friend_request/body_email.html', names)
+        self.assertNotIn('inbox/new_friend_request/body_sms.txt', names)
+
+        TEMPLATES = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'loaders': [('django.template.loaders.locmem.Loader', {
+                    'inbox/broken/subject.txt': '{% if %}',
+                    'other/subject.txt': '',
+                })],
+            },
+        }]
+        with self.settings(TEMPLATES=TEMPLATES):
+            index = get_template_index()
+
+            self.assertEqual(index, ({'inbox/broken/subject.txt'}, True))
+            self.assertTrue(template_exists('inbox/broken/subject.txt', index))
+            self.assertFalse(template_exists('inbox/broken/body.txt', index))
+            self.assertIn('Unexpected end of expression', status._compile('inbox/broken/subject.txt'))
@@ -0,0 +1,219 @@
+import asyncio
+import json
+from unittest.mock import ANY, MagicMock, Mock, patch
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import OperationalError
+from django.test import TestCase
+from django.utils import timezone
+from faker import Faker
+
+from inbox import settings as inbox_settings
+from inbox import signals
+from inbox.models import Message
+from inbox.stream import LocalBroker, PostgresBroker, connect_signals, get_broker, _format_event
+
+User = get_user_model()
+Faker.seed()
+fake = Faker()
+
+
+class StreamTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+
+        inbox_settings.get_config.cache_clear()
+
+    def tearDown(self):
+        super().tearDown()
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_local_broker_fans_out_to_user_subscribers(self):
+        broker = LocalBroker()
+
+        async def run():
+            subscription = broker.subscribe(self.user.pk)
+            other_subscription = broker.subscribe(self.user.pk + 1)
+
+            broker.publish(self.user.pk, 'unread_count', 3)
+
+            event = await asyncio.wait_for(subscription.get(), 1)
+            self.assertEqual(event, ('unread_count', 3))
+            self.assertTrue(other_subscription.queue.empty())
+
+            broker.unsubscribe(subscription)
+            broker.unsubscribe(other_subscription)
+
+        asyncio.run(run())
+
+    def test_signals_publish_to_configured_broker(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['STREAM_BACKEND'] = 'inbox.stream.LocalBroker'
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+            broker = get_broker()
+
+            # Only connected on start up when a backend is configured
+            connect_signals()
+            self.addCleanup(signals.unread_count.disconnect, dispatch_uid='inbox_stream_unread_count')
+            self.addCleanup(signals.new_message.disconnect, dispatch_uid='inbox_stream_new_message')
+
+            # Signals are sent from sync code, the subscriber's loop only runs to receive
+            loop = asyncio.new_event_loop()
+
+            async def subscribe():
+                return broker.subscribe(self.user.pk)
+
+            subscription = loop.run_until_complete(subscribe())
+            try:
+                with self.captureOnCommitCallbacks(execute=True), \
+                        patch.object(broker, 'publish', wraps=broker.publish) as publish:
+                    signals.unread_count.send(sender=Message, user=self.user, count=2)
+                    message = Message(pk=10, user=self.user, key='default')
+                    signals.new_message.send(sender=Message, user=self.user, message=message)
+
+                    # Nothing goes out until the transaction commits
+                    publish.assert_not_called()
+
+                self.assertEqual(publish.call_count, 2)
+                self.assertEqual(loop.run_until_complete(asyncio.wait_for(subscription.get(), 1)),
+                                 ('unread_count', 2))
+                self.assertEqual(loop.run_until_complete(asyncio.wait_for(subscription.get(), 1)),
+                                 ('message', {'id': 10, 'key': 'default'}))
+            finally:
+                broker.unsubscribe(subscription)
+                loop.close()
+
+    def test_format_event(self):
+        self.assertEqual(_format_event('unread_count', 1), 'event: unread_count\ndata: 1\n\n')
+
+    def test_postgres_broker_notify_payload(self):
+        broker = PostgresBroker()
+
+        cursor = MagicMock()
+        with patch('inbox.stream.connections') as connections:
+            connections.__getitem__.return_value.cursor.return_value.__enter__.return_value = cursor
+            broker.publish(self.user.pk, 'message', {'id': 10, 'key': 'default'})
+
+        cursor.execute.assert_called_once_with('SELECT pg_notify(%s, %s)', ['inbox_stream', ANY])
+        payload = cursor.execute.call_args[0][1][1]
+        self.assertEqual(json.loads(payload), {'user_id': str(self.user.pk), 'event': 'message',
+                                               'data': {'id': 10, 'key': 'default'}})
+
+        # The listener fans the same payload out to this process' subscribers
+        listen_connection = MagicMock(notifies=[])
+        listen_connection.poll.side_effect = lambda: listen_connection.notifies.append(Mock(payload=payload))
+
+        ready = iter([([listen_connection], [], [])])
+
+        def select(*args):
+            # Stop once the scripted reads run out
+            return next(ready, None) or stop()
+
+        def stop():
+            broker.stop()
+            return [], [], []
+
+        async def run():
+            # Subscribed without starting the listener thread, it's run directly below
+            subscription = LocalBroker.subscribe(broker, self.user.pk)
+
+            with patch('inbox.stream.connections') as connections, \
+                    patch('inbox.stream.select.select', side_effect=select):
+                connections.__getitem__.return_value.get_new_connection.return_value = listen_connection
+                broker._listen()
+
+            self.assertEqual(await asyncio.wait_for(subscription.get(), 1),
+                             ('message', {'id': 10, 'key': 'default'}))
+            listen_connection.close.assert_called_once_with()
+
+        asyncio.run(run())
+
+    def test_postgres_broker_listener_reconnects(self):
+        broker = PostgresBroker()
+        broker.reconnect_delay = 0
+        payload = json.dumps({'user_id': str(self.user.pk), 'event': 'unread_count', 'data': 1})
+
+        lost_connection = MagicMock(notifies=[])
+        lost_connection.poll.side_effect = OperationalError('server closed the connection unexpectedly')
+        listen_connection = MagicMock(notifies=[])
+        listen_connection.poll.side_effect = lambda: listen_connection.notifies.append(Mock(payload=payload))
+
+        ready = iter([([lost_connection], [], []), ([listen_connection], [], [])])
+
+        def select(*args):
+            return next(ready, None) or stop()
+
+        def stop():
+            broker.stop()
+            return [], [], []
+
+        async def run():
+            subscription = LocalBroker.subscribe(broker, self.user.pk)
+
+            with patch('inbox.stream.connections') as connections, \
+                    patch('inbox.stream.select.select', side_effect=select), \
+                    self.assertLogs('inbox.stream', 'ERROR'):
+                connections.__getitem__.return_value.get_new_connection.side_effect = [lost_connection,
+                                                                                       listen_connection]
+                broker._listen()
+
+            # Subscribers stay attached across the reconnect
+            self.assertEqual(await asyncio.wait_for(subscription.get(), 1), ('unread_count', 1))
+            lost_connection.close.assert_called_once_with()
+            listen_connection.close.assert_called_once_with()
+
+        asyncio.run(run())
+
+
+class StreamViewTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['STREAM_BACKEND'] = 'inbox.stream.LocalBroker'
+        INBOX_CONFIG['STREAM_HEARTBEAT_INTERVAL'] = 0.01
+        override = self.settings(INBOX_CONFIG=INBOX_CONFIG)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_stream_not_found_without_backend(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['STREAM_BACKEND'] = None
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            self.assertEqual(async_to_sync(self.async_client.get)('/stream').status_code, 404)
+
+    def test_stream_requires_authentication(self):
+        self.assertEqual(async_to_sync(self.async_client.get)('/stream').status_code, 401)
+
+    def test_stream_sends_unread_count_then_heartbeats(self):
+        Message.objects.create(user=self.user, key='default')
+        self.async_client.force_login(self.user)
+
+        async def run():
+            response = await self.async_client.get('/stream')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(response['Cache-Control'], 'no-cache')
+
+            content = response.streaming_content
+            try:
+                first, second = await content.__anext__(), await content.__anext__()
+            finally:
+                await content.aclose()
+
+            return first, second
+
+        first, second = async_to_sync(run)()
+
+        self.assertEqual(first, _format_event('unread_count', Message.objects.unread_count(self.user.pk)).encode())
+        self.assertEqual(second, b': keepalive\n\n')
@@ -0,0 +1,386 @@
+import threading
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from faker import Faker
+from freezegun import freeze_time
+
+from inbox import settings as inbox_settings
+from inbox.constants import MessageLogStatus, MessageLogStatusReason, MessageMedium
+from inbox.core import app_push
+from inbox.core.app_push.backends.base import BaseAppPushBackend
+from inbox.core.app_push.backends.locmem import AppPushBackend
+from inbox.management.commands.inbox_worker import Command
+from inbox.models import MediumThrottle, Message, MessageLog
+from inbox import render
+from inbox.throttle import governor
+from inbox.utils import aprocess_message_logs, aprocess_new_message_logs, process_new_messages, claim_message_logs, \
+    get_pending_message_logs, process_message_logs, process_new_message_logs
+from inbox.test.utils import InboxTestCaseMixin
+
+User = get_user_model()
+Faker.seed()
+fake = Faker()
+
+
+class WorkerTestCase(InboxTestCaseMixin, TestCase):
+
+    user = None
+
+    def setUp(self):
+        super().setUp()
+        email = fake.ascii_email()
+        self.user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+        self.user.device_group.notification_key = 'fake-notification_key'
+        self.user.device_group.save()
+
+        inbox_settings.get_config.cache_clear()
+        caches['default'].clear()
+
+        self.command = Command()
+        self.command.poll_interval = 60
+
+    def test_process_sends_due_messages(self):
+        Message.objects.create(user=self.user, key='default')
+
+        # Logs are created on the first pass and sent on the same pass
+        self.assertFalse(self.command.process())
+
+        self.assertEqual(len(app_push.outbox), 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_timeout_waits_for_next_send_at(self):
+        self.assertEqual(self.command.get_timeout(), 60)
+
+        with freeze_time('2020-01-01 00:00:00'):
+            Message.objects.create(user=self.user, key='default',
+                                   send_at=timezone.now() + timezone.timedelta(seconds=30))
+
+            self.assertEqual(self.command.get_timeout(), 30)
+
+        with freeze_time('2020-01-01 00:00:30'):
+            self.command.process()
+
+            self.assertEqual(self.command.get_timeout(), 60)
+            self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_rate_limits_per_user(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['RATE_LIMITS'] = {'app_push': {'rate': 1, 'per': timezone.timedelta(hours=1)}}
+        # Part way through an hour window
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG), freeze_time('2020-01-01 00:20:00'):
+            inbox_settings.get_config.cache_clear()
+
+            Message.objects.create(user=self.user, key='default')
+            Message.objects.create(user=self.user, key='default')
+
+            self.command.process()
+
+            app_push_logs = MessageLog.objects.filter(medium=MessageMedium.APP_PUSH)
+            self.assertEqual(app_push_logs.filter(status=MessageLogStatus.SENT).count(), 1)
+
+            deferred_log = app_push_logs.get(status=MessageLogStatus.NEW)
+            self.assertEqual(deferred_log.send_at, timezone.now() + timezone.timedelta(minutes=40))
+
+            # Email isn't limited
+            self.assertEqual(len(mail.outbox), 2)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_rate_limited_log_keeps_message_send_at_for_max_age(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['RATE_LIMITS'] = {'app_push': {'rate': 1, 'per': timezone.timedelta(days=30)}}
+        # MAX_AGE_BEYOND_SEND_AT is 2 days, the 30 day window ends 8 days later
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG), freeze_time('2020-01-01 00:00:00') as frozen_time:
+            inbox_settings.get_config.cache_clear()
+
+            Message.objects.create(user=self.user, key='default')
+            Message.objects.create(user=self.user, key='default')
+            self.command.process()
+
+            deferred_log = MessageLog.objects.get(medium=MessageMedium.APP_PUSH, status=MessageLogStatus.NEW)
+            self.assertEqual(deferred_log.send_at, timezone.now() + timezone.timedelta(days=8))
+
+            frozen_time.move_to(deferred_log.send_at)
+            self.command.process()
+
+            deferred_log.refresh_from_db()
+            self.assertEqual(deferred_log.status, MessageLogStatus.NOT_SENDABLE)
+            self.assertEqual(deferred_log.status_reason, MessageLogStatusReason.SEND_AT_NOT_IN_RANGE.label)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_process_paces_sends_per_medium(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['BACKENDS'] = {**INBOX_CONFIG['BACKENDS'], 'MAX_SENDS_PER_SECOND': {'email': 10}}
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG), patch('inbox.throttle.time.sleep') as sleep:
+            inbox_settings.get_config.cache_clear()
+            governor.reset()
+
+            for i in range(3):
+                Message.objects.create(user=self.user, key='default')
+
+            self.command.process()
+
+            self.assertEqual(len(mail.outbox), 3)
+
+            # First email goes straight away, the next two are spaced 0.1s apart
+            self.assertEqual(sleep.call_count, 2)
+            self.assertAlmostEqual(governor.wait_seconds['email'], 0.3, delta=0.1)
+            self.assertNotIn('app_push', governor.wait_seconds)
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_wait_inside_a_transaction(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['BACKENDS'] = {**INBOX_CONFIG['BACKENDS'], 'MAX_SENDS_PER_SECOND': {'email': 10}}
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG), patch('inbox.throttle.time.sleep'), \
+                patch.object(connection, 'vendor', 'postgresql'), \
+                patch.object(governor, '_reserve_shared') as reserve_shared:
+            governor.reset()
+
+            # eg under ATOMIC_REQUESTS, paced within the process rather than failing the send
+            with transaction.atomic():
+                self.assertEqual(governor.wait(MessageMedium.EMAIL), 0)
+                self.assertAlmostEqual(governor.wait(MessageMedium.EMAIL), 0.1, delta=0.05)
+
+            reserve_shared.assert_not_called()
+            governor.reset()
+
+    def test_lease_is_renewed_during_a_slow_batch(self):
+        with freeze_time('2020-01-01 00:00:00') as frozen_time:
+            Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+
+            claimed_at = timezone.now()
+            message_logs = claim_message_logs(get_pending_message_logs(), 10)
+            self.assertEqual(len(message_logs), 2)
+            claimed_until = {}
+
+            def slow_send(message_log):
+                claimed_until[message_log.medium] = MessageLog.objects.get(pk=message_log.pk).claimed_until
+                frozen_time.tick(timezone.timedelta(minutes=3))
+
+            with patch.object(MessageLog, 'send', autospec=True, side_effect=slow_send):
+                self.assertEqual(process_message_logs(message_logs), 2)
+
+            first, second = (message_log.medium for message_log in message_logs)
+            self.assertEqual(claimed_until[first], claimed_at + timezone.timedelta(minutes=5))
+            # Half the lease had gone by the second send, so it was extended rather than left to run out
+            self.assertEqual(claimed_until[second], claimed_at + timezone.timedelta(minutes=8))
+            self.assertFalse(get_pending_message_logs(timezone.now() + timezone.timedelta(hours=1)).exists())
+
+    def test_process_message_logs_claims_a_queryset(self):
+        Message.objects.create(user=self.user, key='default')
+        process_new_messages()
+
+        concurrent_claims = []
+
+        def send(message_log):
+            # Another worker looking for logs while these are being sent
+            concurrent_claims.append(claim_message_logs(get_pending_message_logs(), 10))
+
+        queryset = get_pending_message_logs().select_for_update(skip_locked=True)
+        with patch.object(MessageLog, 'send', autospec=True, side_effect=send):
+            self.assertEqual(process_message_logs(queryset), 2)
+
+        self.assertEqual(concurrent_claims, [[], []])
+        self.assertEqual(MessageLog.objects.filter(status=MessageLogStatus.SENT).count(), 2)
+
+    def test_aprocess_new_message_logs(self):
+        for i in range(3):
+            Message.objects.create(user=self.user, key='default')
+
+        process_new_messages()
+        # The silent data pushes go out as the messages are processed
+        self.assertEqual(len(app_push.outbox), 3)
+
+        self.assertEqual(async_to_sync(aprocess_new_message_logs)(concurrency=2), 6)
+
+        self.assertEqual(MessageLog.objects.filter(status=MessageLogStatus.SENT).count(), 6)
+        self.assertEqual(len(app_push.outbox), 6)
+        self.assertEqual(len(mail.outbox), 3)
+
+        # Nothing left to claim
+        self.assertEqual(async_to_sync(aprocess_new_message_logs)(), 0)
+
+    def test_async_push_failure_is_saved_by_the_pipeline(self):
+        Message.objects.create(user=self.user, key='default')
+        process_new_messages()
+
+        def fail(backend, messages):
+            for message in messages:
+                message.message_log.status = MessageLogStatus.FAILED
+                message.message_log.failure_reason = 'Unavailable'
+            return 0
+
+        # Run the way a backend without a native async client is, in a worker thread
+        with patch.object(AppPushBackend, 'send_messages', autospec=True, side_effect=fail), \
+                patch.object(AppPushBackend, 'async_send_messages', BaseAppPushBackend.async_send_messages):
+            self.assertEqual(async_to_sync(aprocess_new_message_logs)(), 2)
+
+        message_log = MessageLog.objects.get(medium=MessageMedium.APP_PUSH)
+        self.assertEqual(message_log.status, MessageLogStatus.NEW)
+        self.assertEqual(message_log.failed_attempts, 1)
+        self.assertEqual(message_log.status_reason, 'Unavailable')
+
+    def test_async_email_is_built_on_the_calling_thread(self):
+        Message.objects.create(user=self.user, key='default')
+        process_new_messages()
+
+        threads = {}
+        build_email = MessageLog._build_email
+        deliver_email = MessageLog._deliver_email
+
+        def record_build(message_log):
+            threads['build'] = threading.current_thread()
+            return build_email(message_log)
+
+        def record_deliver(message_log, msg):
+            threads['deliver'] = threading.current_thread()
+            return deliver_email(message_log, msg)
+
+        with patch.object(MessageLog, '_build_email', autospec=True, side_effect=record_build), \
+                patch.object(MessageLog, '_deliver_email', autospec=True, side_effect=record_deliver):
+            self.assertEqual(async_to_sync(aprocess_new_message_logs)(), 2)
+
+        # ORM and template access stays on the thread sensitive executor, only the send leaves it
+        self.assertIs(threads['build'], threading.current_thread())
+        self.assertIsNot(threads['deliver'], threading.current_thread())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_async(self):
+        self.command.use_async = True
+        Message.objects.create(user=self.user, key='default')
+
+        self.assertFalse(self.command.process())
+
+        self.assertEqual(len(app_push.outbox), 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_process_pool_requires_user_fields(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['PROCESS_RENDER_POOL_SIZE'] = 2
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            with self.assertRaises(ImproperlyConfigured):
+                render.get_executor()
+
+    def test_prerender_in_process_pool(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['PROCESS_RENDER_POOL_SIZE'] = 2
+        INBOX_CONFIG['TEMPLATE_CONTEXT_USER_FIELDS'] = ['email', 'get_username']
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            for i in range(2):
+                Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+
+            message_logs = claim_message_logs(get_pending_message_logs(), 10)
+            try:
+                render.prerender_message_logs(message_logs)
+
+                for message_log in message_logs:
+                    context = message_log._get_context_for_template()
+                    self.assertEqual(message_log.rendered, (
+                        MessageLog.render_subject(message_log.message.key, message_log.medium, context),
+                        MessageLog.render_body(message_log.message.key, message_log.medium, context),
+                    ))
+
+                self.assertEqual(process_message_logs(message_logs), 4)
+            finally:
+                render.shutdown()
+
+            email_log = next(m for m in message_logs if m.medium == MessageMedium.EMAIL)
+            self.assertEqual(len(mail.outbox), 2)
+            self.assertEqual(mail.outbox[0].subject, email_log.rendered[0])
+
+        inbox_settings.get_config.cache_clear()
+
+    def test_only_logs_that_send_are_prerendered(self):
+        for process in (process_message_logs, async_to_sync(aprocess_message_logs)):
+            Message.objects.create(user=self.user, key='default')
+            process_new_messages()
+
+            # App pushes aren't sendable without a notification key
+            self.user.device_group.notification_key = None
+            self.user.device_group.save()
+
+            message_logs = claim_message_logs(get_pending_message_logs(), 10)
+            with patch.object(render, 'prerender_message_logs') as prerender_message_logs:
+                self.assertEqual(process(message_logs), 2)
+
+            prerendered = prerender_message_logs.call_args[0][0]
+            self.assertEqual([message_log.medium for message_log in prerendered], [MessageMedium.EMAIL])
+            self.assertEqual({message_log.status for message_log in message_logs},
+                             {MessageLogStatus.SENT, MessageLogStatus.NOT_SENDABLE})
+            self.assertFalse(MessageLog.objects.filter(pk__in=[m.pk for m in message_logs],
+                                                       claimed_until__isnull=False).exists())
+
+            self.user.device_group.notification_key = 'fake-notification_key'
+            self.user.device_group.save()
+
+    def test_user_context(self):
+        self.assertEqual(render.get_user_context(self.user, ['email', 'device_group.notification_key']), {
+            'email': self.user.email,
+            'device_group': {'notification_key': 'fake-notification_key'},
+        })
+        self.assertNotIn('password', render.get_user_context(self.user))
+
+    def test_process_logs_select_queries_per_batch(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['PROCESS_LOGS_SELECT_RELATED'] = ['message__user__message_preferences',
+                                                       'message__user__device_group']
+
+        def count_selects(user_count):
+            for i in range(user_count):
+                email = fake.ascii_email()
+                user = User.objects.create(email=email, email_verified_on=timezone.now().date(), username=email)
+                user.device_group.notification_key = 'fake-notification_key'
+                user.device_group.save()
+                user.message_preferences
+                Message.objects.create(user=user, key='default')
+
+            process_new_messages()
+
+            with CaptureQueriesContext(connection) as context:
+                process_new_message_logs()
+
+            return len([query for query in context.captured_queries if query['sql'].startswith('SELECT')])
+
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            inbox_settings.get_config.cache_clear()
+
+            self.assertEqual(count_selects(1), 1)
+            self.assertEqual(count_selects(3), 1)
+
+        inbox_settings.get_config.cache_clear()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Sends are only paced across workers under PostgreSQL')
+class SharedThrottleTestCase(TransactionTestCase):
+
+    def test_shared_reservations_are_spaced(self):
+        INBOX_CONFIG = settings.INBOX_CONFIG.copy()
+        INBOX_CONFIG['BACKENDS'] = {**INBOX_CONFIG['BACKENDS'], 'MAX_SENDS_PER_SECOND': {'email': 10}}
+        with self.settings(INBOX_CONFIG=INBOX_CONFIG):
+            governor.reset()
+
+            self.assertEqual(governor.reserve(MessageMedium.EMAIL), 0)
+            self.assertAlmostEqual(governor.reserve(MessageMedium.EMAIL), 0.1, delta=0.05)
+            self.assertAlmostEqual(governor.reserve(MessageMedium.EMAIL), 0.2, delta=0.05)
+            self.assertTrue(MediumThrottle.objects.filter(medium=MessageMedium.EMAIL).exists())
+            # Local pacing isn't used alongside the shared slots
+            self.assertNotIn(MessageMedium.EMAIL, governor._next_send_at)
+
+            governor.reset()
@@ -2,6 +2,8 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import include, re_path
 
 from inbox.cron import view_process_new_messages, view_process_new_message_logs
+from inbox.metrics import view_metrics
+from inbox.stream import view_message_stream
 from inbox.views import MessageViewSet, NestedMessagesViewSet, MessagePreferencesViewSet
 from rest_framework_extensions.routers import ExtendedSimpleRouter
 
@@ -24,6 +26,8 @@ urlpatterns = [
     re_path(r'^api/(?P<version>v1)/', include(router.urls)),
     re_path(r'^cron/process_new_messages$', view_process_new_messages),
     re_path(r'^cron/process_new_message_logs$', view_process_new_message_logs),
+    re_path(r'^stream$', view_message_stream),
+    re_path(r'^metrics$', view_metrics),
 ]
 
 urlpatterns += staticfiles_urlpatterns()